@@ -0,0 +1,332 @@
+"""Офлайн-бенчмарк SS14 Helper.
+
+Поднимает локально синтетическую вики в разметке MediaWiki, фальшивый хаб серверов (/api/servers) и
+имитацию прокси Gemini с настраиваемой задержкой, после чего прогоняет на временной БД паука, поиск
+контекста на корпусах разного размера и полный цикл ask_gemini. Результат — JSON для отслеживания регрессий.
+
+    python benchmark.py --output bench.json
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+# Бюджет холодного импорта main.py, мс. Паук, разбор HTML, отрисовка ответа и HTTP-сервис грузятся
+# только при использовании, поэтому после импорта их модулей быть не должно
+IMPORT_BUDGET_MS = 700
+DEFERRED_MODULES = ('requests', 'bs4', 'lxml', 'rich.markdown', 'rich.live', 'rich.progress', 'aiohttp.web')
+
+# ==============================================================================
+# --- СИНТЕТИЧЕСКИЙ КОРПУС ---
+# ==============================================================================
+
+TERMS = [
+    'плазма', 'химия', 'медицина', 'инженер', 'двигатель', 'сингулярность', 'тесла', 'атмосфера',
+    'скафандр', 'оружие', 'ботаника', 'генетика', 'клонирование', 'борг', 'снабжение', 'шаттл',
+    'эвакуация', 'предатель', 'оперативник', 'революция', 'генокрад', 'станция', 'капитан', 'охрана',
+    'детектив', 'уборщик', 'повар', 'бармен', 'шахтер', 'руда', 'утилизатор', 'провода', 'аккумулятор',
+    'антиматерия', 'гравитация', 'азот', 'кислород', 'тритий', 'давление', 'температура', 'разгерметизация',
+    'реагент', 'таблетка', 'криокапсула', 'хирургия', 'дефибриллятор', 'радиация', 'аномалия', 'артефакт',
+]
+HEADINGS = ['Описание', 'Механика', 'Рецепт', 'Получение', 'Использование', 'Советы', 'История', 'См. также']
+SYLLABLES = ['ка', 'ро', 'ми', 'ту', 'ле', 'на', 'зо', 'ви', 'ст', 'пра', 'ген', 'мод', 'лор', 'фаз']
+# Слова общего словаря с частотой по закону Ципфа: термины встречаются часто, "хвост" — редко
+FILLER = [''.join(random.Random(i).choices(SYLLABLES, k=3)) for i in range(2000)]
+VOCABULARY = TERMS + FILLER
+WEIGHTS = [1 / (rank + 1) for rank in range(len(VOCABULARY))]
+
+def synthetic_article(i, pages_total):
+    """Детерминированная статья номер i: (заголовок, [(раздел, текст), ...], номера статей по ссылкам)."""
+    rnd = random.Random(i)
+    title = f"{TERMS[i % len(TERMS)].capitalize()} {i}"
+    sections = [("", ' '.join(rnd.choices(VOCABULARY, WEIGHTS, k=rnd.randint(20, 60))) + '.')]
+    for heading in rnd.sample(HEADINGS, rnd.randint(2, 5)):
+        paragraphs = [' '.join(rnd.choices(VOCABULARY, WEIGHTS, k=rnd.randint(30, 120))) + '.' for _ in range(rnd.randint(1, 3))]
+        sections.append((heading, '\n'.join(paragraphs)))
+    links = [rnd.randrange(pages_total) for _ in range(12)]
+    return title, sections, links
+
+def render_article(i, pages_total):
+    title, sections, links = synthetic_article(i, pages_total)
+    body = []
+    for heading, text in sections:
+        if heading: body.append(f'<div class="mw-heading mw-heading2"><h2 id="{heading}">{heading}</h2><span class="mw-editsection">[<a href="/w/index.php?title=P{i}&amp;action=edit">править</a>]</span></div>')
+        body.extend(f'<p>{paragraph}</p>' for paragraph in text.split('\n'))
+    body.append('<ul>' + ''.join(f'<li><a href="/wiki/P{target}">{synthetic_article(target, pages_total)[0]}</a></li>' for target in links) + '</ul>')
+    return (f'<!DOCTYPE html><html><head><meta charset="UTF-8"><title>{title}</title><script>var wg = {{}};</script></head>'
+            f'<body><div id="content"><h1 id="firstHeading">{title}</h1><div id="bodyContent"><div class="mw-parser-output">'
+            + ''.join(body) + '</div></div></div><div id="footer"><a href="/wiki/Special:Random">Случайная</a></div></body></html>')
+
+def article_write(i, pages_total, site="bench.local"):
+    """Готовая запись для BatchWriter, минуя загрузку и разбор: так корпус нужного размера набирается быстро."""
+    title, sections, links = synthetic_article(i, pages_total)
+    links_json = json.dumps([f"/wiki/P{target}" for target in links])
+    article = dict(title=title, content='\n'.join(text for _, text in sections), sections=sections, links_json=links_json, content_hash=f"synthetic-{i}")
+    return helper.prepare_article_write(f"https://{site}/wiki/P{i}", article)[1]
+
+# ==============================================================================
+# --- ЛОКАЛЬНЫЕ ЗАГЛУШКИ: ВИКИ, ХАБ, ПРОКСИ ---
+# ==============================================================================
+
+def gemini_response(text):
+    return {"candidates": [{"content": {"parts": [{"text": text}]}}]}
+
+def make_stand_in_app(args):
+    async def wiki_page(request):
+        i = int(request.match_info['i'])
+        if i >= args.wiki_pages: raise web.HTTPNotFound()
+        if args.wiki_latency: await asyncio.sleep(args.wiki_latency)
+        etag = f'"p{i}"'
+        if request.headers.get('If-None-Match') == etag: return web.Response(status=304, headers={'ETag': etag})
+        return web.Response(text=render_article(i, args.wiki_pages), content_type='text/html', charset='utf-8', headers={'ETag': etag})
+
+    async def hub_servers(request):
+        rnd = random.Random(0)
+        return web.json_response([dict(address=f"ss14://bench-{n}.local:1212", name=f"Сервер {n}", players=rnd.randrange(100)) for n in range(args.hub_servers)])
+
+    async def proxy(request):
+        body = await request.json()
+        await asyncio.sleep(args.proxy_latency)
+        prompt = body['contents'][0]['parts'][0]['text']
+        rnd = random.Random(prompt)
+        if body.get('generationConfig', {}).get('temperature') == 0.0:
+            return web.json_response(gemini_response(', '.join(rnd.sample(TERMS, 3))))
+        pieces = [' '.join(rnd.choices(TERMS, k=12)) + '.\n' for _ in range(args.proxy_chunks)]
+        if request.query.get('alt') != 'sse': return web.json_response(gemini_response(''.join(pieces)))
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        for piece in pieces:
+            await response.write(f"data: {json.dumps(gemini_response(piece), ensure_ascii=False)}\n\n".encode('utf-8'))
+            await asyncio.sleep(args.proxy_chunk_delay)
+        await response.write_eof()
+        return response
+
+    app = web.Application(client_max_size=8 * 1024 * 1024)
+    app.router.add_get('/wiki/P{i:\\d+}', wiki_page)
+    app.router.add_get('/hub/api/servers', hub_servers)
+    app.router.add_post('/api/proxy', proxy)
+    return app
+
+class StandInServer(threading.Thread):
+    """Заглушки работают в собственном потоке и цикле событий: сам помощник вызывает asyncio.run и
+    синхронный requests, и заглушки должны отвечать независимо от этого."""
+    def __init__(self, args):
+        super().__init__(daemon=True)
+        self.args = args; self.ready = threading.Event()
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0)); self.port = probe.getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{self.port}"
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        runner = web.AppRunner(make_stand_in_app(self.args), access_log=None)
+        self.loop.run_until_complete(runner.setup())
+        self.loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', self.port).start())
+        self.ready.set()
+        self.loop.run_forever()
+
+# ==============================================================================
+# --- ЗАМЕРЫ ---
+# ==============================================================================
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))]
+
+def latency_summary(seconds):
+    return dict(count=len(seconds), p50_ms=round(percentile(seconds, 50) * 1000, 3), p99_ms=round(percentile(seconds, 99) * 1000, 3),
+                mean_ms=round(sum(seconds) / len(seconds) * 1000, 3), max_ms=round(max(seconds) * 1000, 3))
+
+def count_rows(table):
+    with helper.get_engine().connect() as connection:
+        return connection.execute(helper.sqlalchemy.select(helper.sqlalchemy.func.count()).select_from(table)).scalar()
+
+def database_bytes():
+    """Размер файла БД после переноса WAL в основной файл."""
+    with helper.get_engine().begin() as connection:
+        connection.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+    return os.path.getsize(helper.DB_NAME)
+
+def quiet_progress():
+    from rich.progress import Progress
+    return Progress(disable=True)
+
+def bench_import(runs, budget_ms):
+    """Время `import main` в свежем интерпретаторе (медиана по runs запускам) и отложенные модули, загруженные раньше времени."""
+    probe = ("import json, sys, time; sys.path.insert(0, {!r}); started = time.perf_counter(); import main; "
+             "print(json.dumps([(time.perf_counter() - started) * 1000, [name for name in {!r} if name in sys.modules]]))").format(REPO_DIR, DEFERRED_MODULES)
+    timings, loaded = [], set()
+    for _ in range(runs):
+        milliseconds, modules = json.loads(subprocess.run([sys.executable, '-c', probe], capture_output=True, text=True, check=True).stdout)
+        timings.append(milliseconds); loaded.update(modules)
+    median = statistics.median(timings)
+    return dict(runs=runs, median_ms=round(median, 1), min_ms=round(min(timings), 1), budget_ms=budget_ms,
+                deferred_modules_loaded=sorted(loaded), within_budget=median <= budget_ms and not loaded)
+
+def bench_servers():
+    progress = quiet_progress(); task_id = progress.add_task("Серверы", total=1)
+    started = time.perf_counter()
+    helper.fetch_servers_with_progress(progress, task_id)
+    seconds = time.perf_counter() - started
+    servers = count_rows(helper.servers_table)
+    return dict(servers=servers, seconds=round(seconds, 3), servers_per_s=round(servers / seconds, 1))
+
+def bench_crawl(start_url):
+    """Полный обход синтетической вики; вызывается дважды: первый раз все страницы новые,
+    второй — условные запросы получают 304 и в БД почти ничего не пишется."""
+    progress = quiet_progress(); overall = progress.add_task("Общий прогресс", total=1)
+    articles_before = count_rows(helper.wiki_articles_table)
+    started = time.perf_counter()
+    writer = asyncio.run(helper.crawl_all_sites(progress, overall, [start_url], full=True))
+    seconds = time.perf_counter() - started
+    # Каждая страница ссылается на 12 случайных, так что обход доходит до всей вики
+    pages = helper.SETTINGS["max_pages_per_crawl"]
+    return dict(pages=pages, new_articles=count_rows(helper.wiki_articles_table) - articles_before, seconds=round(seconds, 3),
+                pages_per_s=round(pages / seconds, 1), db_rows=writer.rows_written, db_rows_per_s=round(writer.rate, 1))
+
+def fill_corpus(target, pages_total):
+    """Догружает синтетические статьи через BatchWriter, пока в базе не станет target статей."""
+    existing = count_rows(helper.wiki_articles_table)
+    if existing >= target: return None
+
+    async def load():
+        writer = helper.BatchWriter()
+        for i in range(existing, target): await writer.add(article_write(i, pages_total))
+        await writer.close()
+        return writer
+    started = time.perf_counter()
+    writer = asyncio.run(load())
+    seconds = time.perf_counter() - started
+    return dict(articles=target - existing, seconds=round(seconds, 3), db_rows=writer.rows_written, db_rows_per_s=round(writer.rate, 1))
+
+def bench_retrieval(queries_count, seed):
+    rnd = random.Random(seed)
+    queries = [rnd.sample(TERMS, rnd.randint(1, 3)) + rnd.sample(FILLER[:200], rnd.randint(0, 2)) for _ in range(queries_count)]
+    helper.find_relevant_context(queries[0])
+    timings, context_chars = [], 0
+    for keywords in queries:
+        started = time.perf_counter()
+        context = helper.find_relevant_context(keywords)
+        timings.append(time.perf_counter() - started); context_chars += len(context)
+    return dict(articles=count_rows(helper.wiki_articles_table), passages=count_rows(helper.wiki_passages_table),
+                text_blobs=count_rows(helper.text_blobs_table), database_bytes=database_bytes(), mean_context_chars=round(context_chars / len(queries)), **latency_summary(timings))
+
+def bench_ask(questions_count, seed):
+    """ask_gemini целиком: новый вопрос (поиск + прокси со стримингом), повтор (кэш), и время до первого куска ответа."""
+    rnd = random.Random(seed)
+    questions = [f"как работает {' '.join(rnd.sample(TERMS, 2))} {n}" for n in range(questions_count)]
+    cold, cached, first_chunk, errors = [], [], [], 0
+    for question in questions:
+        started = time.perf_counter()
+        answer = helper.ask_gemini(question)
+        cold.append(time.perf_counter() - started)
+        if answer.startswith('[bold red]'): errors += 1
+        started = time.perf_counter()
+        helper.ask_gemini(question)
+        cached.append(time.perf_counter() - started)
+    for question in questions:
+        chunk_times = []
+        started = time.perf_counter()
+        asyncio.run(helper.answer_question(f"{question} снова", on_text=lambda text: chunk_times.append(time.perf_counter() - started)))
+        if chunk_times: first_chunk.append(chunk_times[0])
+    result = dict(cold=latency_summary(cold), cached=latency_summary(cached), errors=errors)
+    if first_chunk: result['first_chunk'] = latency_summary(first_chunk)
+    return result
+
+# ==============================================================================
+# --- ЗАПУСК ---
+# ==============================================================================
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк SS14 Helper (локальная вики, хаб и прокси).")
+    parser.add_argument('--output', metavar='FILE', help="куда записать JSON (по умолчанию stdout)")
+    parser.add_argument('--wiki-pages', type=int, default=1000, help="страниц в синтетической вики; паук обходит ее целиком")
+    parser.add_argument('--wiki-latency', type=float, default=0.005, help="задержка ответа вики, с")
+    parser.add_argument('--concurrency', type=int, default=8, help="crawler_concurrency_per_host")
+    parser.add_argument('--hub-servers', type=int, default=2000, help="серверов в ответе хаба")
+    parser.add_argument('--corpus-sizes', default="1000,5000,20000", help="размеры корпуса (статей) для замера поиска")
+    parser.add_argument('--queries', type=int, default=300, help="запросов поиска на каждый размер корпуса")
+    parser.add_argument('--questions', type=int, default=20, help="вопросов для замера ask_gemini")
+    parser.add_argument('--proxy-latency', type=float, default=0.2, help="задержка прокси до начала ответа, с")
+    parser.add_argument('--proxy-chunks', type=int, default=10, help="частей в потоковом ответе прокси")
+    parser.add_argument('--proxy-chunk-delay', type=float, default=0.02, help="пауза между частями потокового ответа, с")
+    parser.add_argument('--import-runs', type=int, default=5, help="запусков для замера времени импорта")
+    parser.add_argument('--import-budget-ms', type=float, default=IMPORT_BUDGET_MS, help="бюджет времени импорта main.py, мс")
+    parser.add_argument('--workdir', help="каталог для settings.json и БД (по умолчанию временный, удаляется)")
+    parser.add_argument('--seed', type=int, default=14)
+    return parser.parse_args()
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+def run(args, stand_in, import_time):
+    results = dict(meta=dict(started_at=datetime.now(timezone.utc).isoformat(timespec='seconds'), python=platform.python_version(),
+                             platform=platform.platform(), cpu_count=os.cpu_count(), lxml=helper.load_lxml_html() is not None,
+                             fts5=helper.FTS_AVAILABLE, params={key: value for key, value in vars(args).items() if key not in ('output', 'workdir')}),
+                   import_time=import_time)
+    log("Серверы из хаба..."); results['servers'] = bench_servers()
+    start_url = f"{stand_in.base_url}/wiki/P0"
+    log("Полный обход вики..."); results['crawl'] = bench_crawl(start_url)
+    log("Повторный обход (условные запросы)..."); results['recrawl'] = bench_crawl(start_url)
+    results['corpus_load'], results['retrieval'] = [], []
+    for size in sorted({int(size) for size in args.corpus_sizes.split(',') if size.strip()}):
+        log(f"Поиск контекста на корпусе {size} статей...")
+        loaded = fill_corpus(size, args.wiki_pages)
+        if loaded: results['corpus_load'].append(loaded)
+        results['retrieval'].append(bench_retrieval(args.queries, args.seed))
+    log("ask_gemini целиком..."); results['ask_gemini'] = dict(proxy_latency_s=args.proxy_latency, **bench_ask(args.questions, args.seed))
+    # Разбивка по этапам из встроенных замеров помощника
+    results['stages'] = helper.STAGE_TIMINGS.snapshot()
+    return results
+
+def main():
+    global helper
+    args = parse_args()
+    workdir = args.workdir or tempfile.mkdtemp(prefix='ss14-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    stand_in = StandInServer(args); stand_in.start(); stand_in.ready.wait()
+    settings = dict(gemini_api_key="benchmark", crawler_start_urls=[f"{stand_in.base_url}/wiki/P0"], max_pages_per_crawl=args.wiki_pages,
+                    crawler_concurrency_per_host=args.concurrency, crawler_requests_per_second=1000.0, crawler_incremental=False,
+                    current_server_context="all")
+    with open(os.path.join(workdir, 'settings.json'), 'w', encoding='utf-8') as f:
+        json.dump(settings, f, indent=4, ensure_ascii=False)
+    output = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    previous_dir = os.getcwd()
+    try:
+        # Помощник открывает settings.json и БД по относительным путям при первом обращении
+        os.chdir(workdir); sys.path.insert(0, REPO_DIR)
+        log("Время импорта..."); import_time = bench_import(args.import_runs, args.import_budget_ms)
+        # Интерфейс rich (спиннеры ask_gemini) уходит в stderr, чтобы не смешиваться с JSON
+        with contextlib.redirect_stdout(sys.stderr):
+            import main as helper
+            helper.VERCEL_PROXY_URL = f"{stand_in.base_url}/api/proxy"
+            helper.VERCEL_PROXY_STREAM_URL = f"{helper.VERCEL_PROXY_URL}?alt=sse"
+            helper.SERVERS_HUB_URL = f"{stand_in.base_url}/hub/api/servers"
+            helper.get_engine()
+            results = run(args, stand_in, import_time)
+        json.dump(results, output, indent=2, ensure_ascii=False); output.write('\n')
+    finally:
+        os.chdir(previous_dir)
+        if output is not sys.stdout: output.close()
+        if not args.workdir: shutil.rmtree(workdir, ignore_errors=True)
+    # Превышение бюджета импорта — ненулевой код выхода, чтобы регрессию было видно в CI
+    if not results['import_time']['within_budget']: sys.exit(1)
+
+if __name__ == '__main__':
+    main()
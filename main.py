@@ -1,25 +1,44 @@
 # -*- coding: utf-8 -*-
 
-import requests
-from bs4 import BeautifulSoup
+# Тяжелые зависимости паука и разбора HTML (requests, bs4, lxml), отрисовки ответа (rich.markdown, rich.live)
+# и HTTP-сервиса (aiohttp.web) импортируются внутри функций, которым они нужны: большинство запусков
+# только задает вопросы, и первое приглашение не должно ждать загрузки всего сразу
+import aiohttp
+import asyncio
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 import sqlalchemy
 from sqlalchemy import text
 import os
 import json
 import time
 import re
-from collections import deque
-from urllib.parse import urljoin, urlparse, unquote
+import contextlib
+import sys
+import argparse
+import threading
+import codecs
+from html import unescape
+import cProfile
+import io
+import pstats
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import heapq
+import hashlib
+import zlib
+from datetime import datetime, timedelta, timezone
+from collections import defaultdict, OrderedDict, deque
+from collections.abc import MutableMapping
+import functools
+from urllib.parse import urljoin, urlparse, unquote, quote, urlsplit, urlunsplit, parse_qsl, urlencode
 
 # Импорты для красивого интерфейса
 from rich.console import Console
 from rich.panel import Panel
-from rich.markdown import Markdown
-from rich.live import Live
-from rich.spinner import Spinner
 from rich.prompt import Prompt
-from rich.progress import Progress, SpinnerColumn, BarColumn, TextColumn, TimeElapsedColumn, MofNCompleteColumn
-from rich.layout import Layout
+from rich.table import Table
 
 # ==============================================================================
 # --- КОНФИГУРАЦИЯ И РАБОТА С НАСТРОЙКАМИ ---
@@ -37,6 +56,20 @@ def load_settings():
             "https://wiki.deadspace14.net/Заглавная_страница"
         ],
         "max_pages_per_crawl": 50,
+        "crawler_concurrency_per_host": 4,
+        "crawler_requests_per_second": 5.0,
+        "crawler_incremental": True,
+        "parser_workers": 0,
+        "context_char_budget": 12000,
+        "cache_ttl_hours": 72,
+        "cache_max_entries": 2000,
+        "gemini_streaming": True,
+        "retrieval_speculative_refine": True,
+        "retrieval_budgets": {"search": 2.0, "refine": 30.0, "total": 35.0},
+        "service_concurrency": 8,
+        "service_max_pending": 64,
+        "stats_export_path": "",
+        "stats_export_format": "prometheus",
         "current_server_context": "all"
     }
     try:
@@ -59,16 +92,163 @@ def save_settings():
     """Сохраняет текущие настройки в файл."""
     try:
         with open(SETTINGS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(SETTINGS, f, indent=4, ensure_ascii=False)
+            json.dump(dict(SETTINGS), f, indent=4, ensure_ascii=False)
         console.print("[bold green]Настройки успешно сохранены.[/bold green]")
     except IOError as e:
         console.print(f"[bold red]Не удалось сохранить настройки: {e}[/bold red]")
 
-SETTINGS = load_settings()
+class LazySettings(MutableMapping):
+    """Настройки — ленивый синглтон: settings.json читается (и при необходимости создается) при первом обращении,
+    а не при импорте модуля."""
+    def __init__(self):
+        self._data = None; self._lock = threading.Lock()
+
+    def _loaded(self):
+        if self._data is None:
+            with self._lock:
+                if self._data is None: self._data = load_settings()
+        return self._data
+
+    def get(self, key, default=None): return self._loaded().get(key, default)
+    def __getitem__(self, key): return self._loaded()[key]
+    def __setitem__(self, key, value): self._loaded()[key] = value
+    def __delitem__(self, key): del self._loaded()[key]
+    def __iter__(self): return iter(self._loaded())
+    def __len__(self): return len(self._loaded())
+
+SETTINGS = LazySettings()
 VERCEL_PROXY_URL = "https://my-game-proxy.vercel.app/api/proxy"
+# Потоковый (SSE) вариант того же эндпоинта, как у streamGenerateContent в Gemini API
+VERCEL_PROXY_STREAM_URL = f"{VERCEL_PROXY_URL}?alt=sse"
+SERVERS_HUB_URL = 'https://central.spacestation14.io/hub/api/servers'
 DB_NAME = 'ss14_data.db'
-engine = sqlalchemy.create_engine(f'sqlite:///{DB_NAME}')
+# Пул соединений с БД общий для всех потоков; в неинтерактивном режиме под него же подобран пул потоков
+DB_POOL_SIZE = 5
+DB_POOL_OVERFLOW = 10
 metadata = sqlalchemy.MetaData()
+_engine = None
+_engine_lock = threading.RLock()
+_database_ready = False
+
+def get_engine():
+    """Движок БД — ленивый синглтон: создается при первом обращении, тогда же один раз готовится схема
+    (setup_database). Остальные потоки ждут окончания подготовки; setup_database в том же потоке получает движок сразу."""
+    global _engine, _database_ready
+    if _database_ready: return _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = sqlalchemy.create_engine(f'sqlite:///{DB_NAME}', pool_size=DB_POOL_SIZE, max_overflow=DB_POOL_OVERFLOW)
+            sqlalchemy.event.listen(_engine, "connect", _set_sqlite_pragmas)
+            try:
+                setup_database()
+            except Exception:
+                # Следующее обращение попробует подготовить БД заново
+                _engine.dispose(); _engine = None
+                raise
+            _database_ready = True
+        return _engine
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL: чтение в find_relevant_context не блокируется идущей записью паука, и наоборот
+    cursor = dbapi_connection.cursor()
+    for pragma in ("journal_mode=WAL", "synchronous=NORMAL", "busy_timeout=5000", "temp_store=MEMORY", "cache_size=-20000"):
+        cursor.execute(f"PRAGMA {pragma}")
+    cursor.close()
+    # Распаковка текстов прямо в SQL: ее используют индекс FTS5 (триггеры и rebuild) и поиск через LIKE без FTS5
+    dbapi_connection.create_function('blob_text', 2, decompress_text, deterministic=True)
+
+# ==============================================================================
+# --- ЗАМЕРЫ ВРЕМЕНИ ЭТАПОВ ---
+# ==============================================================================
+
+# Сколько последних замеров каждого этапа хранить для перцентилей
+STAGE_WINDOW = 1000
+STAGE_QUANTILES = (50, 95, 99)
+
+class StageTimings:
+    """Скользящие окна длительностей по этапам (поиск, запросы к прокси, загрузка и разбор страниц, запись в БД)
+    и их выгрузка в файл stats_export_path в формате Prometheus или JSONL."""
+    def __init__(self, window=STAGE_WINDOW):
+        self.window = window; self.lock = threading.Lock()
+        self.samples = {}; self.totals = defaultdict(lambda: [0, 0.0]); self.unexported = []
+        self.export_lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.samples.setdefault(stage, deque(maxlen=self.window)).append(seconds)
+            total = self.totals[stage]; total[0] += 1; total[1] += seconds
+            if SETTINGS.get("stats_export_path") and SETTINGS.get("stats_export_format") == "jsonl":
+                self.unexported.append((time.time(), stage, seconds))
+
+    @contextlib.contextmanager
+    def span(self, stage):
+        """Замеряет блок кода. Прерванные ошибкой или отменой этапы не учитываются, чтобы не искажать перцентили."""
+        started = time.perf_counter()
+        yield
+        self.record(stage, time.perf_counter() - started)
+
+    def snapshot(self):
+        """{этап: {count, sum, p50, p95, p99}}; перцентили считаются по скользящему окну, count и sum — за все время."""
+        with self.lock:
+            windows = {stage: sorted(samples) for stage, samples in self.samples.items()}
+            totals = {stage: tuple(self.totals[stage]) for stage in windows}
+        result = {}
+        for stage, ordered in sorted(windows.items()):
+            result[stage] = dict(count=totals[stage][0], sum=totals[stage][1])
+            for q in STAGE_QUANTILES: result[stage][f"p{q}"] = ordered[max(0, -(-q * len(ordered) // 100) - 1)]
+        return result
+
+    def prometheus_text(self):
+        lines = ["# HELP ss14_helper_stage_seconds Длительность этапов SS14 Helper (перцентили по последним замерам).", "# TYPE ss14_helper_stage_seconds summary"]
+        for stage, stats in self.snapshot().items():
+            for q in STAGE_QUANTILES: lines.append(f'ss14_helper_stage_seconds{{stage="{stage}",quantile="{q / 100}"}} {stats[f"p{q}"]:.6f}')
+            lines.append(f'ss14_helper_stage_seconds_sum{{stage="{stage}"}} {stats["sum"]:.6f}')
+            lines.append(f'ss14_helper_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self):
+        """Выгружает замеры, если задан stats_export_path: prometheus — снимок целиком (файл перезаписывается
+        атомарно, подходит для textfile-коллектора), jsonl — новые замеры построчно (дозапись)."""
+        path = SETTINGS.get("stats_export_path", "")
+        if not path: return
+        with self.export_lock:
+            try:
+                if SETTINGS.get("stats_export_format", "prometheus") == "jsonl":
+                    with self.lock:
+                        records, self.unexported = self.unexported, []
+                    with open(path, 'a', encoding='utf-8') as f:
+                        f.writelines(json.dumps(dict(ts=round(ts, 3), stage=stage, seconds=round(seconds, 6)), ensure_ascii=False) + '\n' for ts, stage, seconds in records)
+                else:
+                    with open(f"{path}.tmp", 'w', encoding='utf-8') as f: f.write(self.prometheus_text())
+                    os.replace(f"{path}.tmp", path)
+            except OSError as e:
+                console.print(f"[yellow]Не удалось выгрузить статистику в '{path}': {e}[/yellow]")
+
+STAGE_TIMINGS = StageTimings()
+
+def show_statistics():
+    stats = STAGE_TIMINGS.snapshot()
+    if not stats:
+        console.print("[yellow]Замеров пока нет: задайте вопрос или запустите 'обновить'.[/yellow]"); return
+    table = Table(title=f"Время этапов, мс (последние {STAGE_WINDOW} замеров)", border_style="blue")
+    table.add_column("Этап", style="cyan"); table.add_column("Замеров", justify="right")
+    for q in STAGE_QUANTILES: table.add_column(f"p{q}", justify="right")
+    table.add_column("Всего, с", justify="right")
+    for stage, values in stats.items():
+        table.add_row(stage, str(values["count"]), *(f"{values[f'p{q}'] * 1000:.1f}" for q in STAGE_QUANTILES), f"{values['sum']:.1f}")
+    console.print(table)
+
+def profile_question(query):
+    """Отвечает на один вопрос под cProfile: профиль сохраняется в .prof-файл, самые дорогие функции выводятся на экран.
+    Работа в пулах потоков (поиск в БД) в профиль основного потока не попадает, ее видно в 'статистика'."""
+    profiler = cProfile.Profile()
+    answer = profiler.runcall(ask_gemini, query)
+    profile_path = f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.prof"
+    profiler.dump_stats(profile_path)
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(20)
+    console.print(Panel(report.getvalue().strip(), title=f"[cyan]Профиль вопроса[/cyan] [dim]({profile_path})[/dim]", border_style="cyan"))
+    return answer
 
 # ==============================================================================
 # --- МЕНЮ НАСТРОЕК И КОНТЕКСТА ---
@@ -153,85 +333,819 @@ def manage_settings():
 # ==============================================================================
 
 servers_table = sqlalchemy.Table('servers', metadata, sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True), sqlalchemy.Column('name', sqlalchemy.String), sqlalchemy.Column('address', sqlalchemy.String, unique=True), sqlalchemy.Column('players_online', sqlalchemy.Integer), sqlalchemy.Column('last_seen', sqlalchemy.DateTime, default=sqlalchemy.func.now(), onupdate=sqlalchemy.func.now()))
-wiki_articles_table = sqlalchemy.Table('wiki_articles', metadata, sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True), sqlalchemy.Column('title', sqlalchemy.String), sqlalchemy.Column('content', sqlalchemy.Text), sqlalchemy.Column('source', sqlalchemy.String, unique=True), sqlalchemy.Column('last_updated', sqlalchemy.DateTime, default=sqlalchemy.func.now(), onupdate=sqlalchemy.func.now()))
+# Текст статьи лежит в text_blobs (text_hash); колонка content осталась от старых баз и после миграции пуста
+wiki_articles_table = sqlalchemy.Table('wiki_articles', metadata, sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True), sqlalchemy.Column('title', sqlalchemy.String), sqlalchemy.Column('content', sqlalchemy.Text), sqlalchemy.Column('source', sqlalchemy.String, unique=True), sqlalchemy.Column('last_updated', sqlalchemy.DateTime, default=sqlalchemy.func.now(), onupdate=sqlalchemy.func.now()), sqlalchemy.Column('text_hash', sqlalchemy.String, index=True))
+# Валидаторы HTTP-кэша и хэш содержимого каждой страницы: позволяют не качать и не переписывать неизменившееся
+page_validators_table = sqlalchemy.Table('page_validators', metadata, sqlalchemy.Column('source', sqlalchemy.String, primary_key=True), sqlalchemy.Column('etag', sqlalchemy.String), sqlalchemy.Column('last_modified', sqlalchemy.String), sqlalchemy.Column('content_hash', sqlalchemy.String), sqlalchemy.Column('links', sqlalchemy.Text), sqlalchemy.Column('last_checked', sqlalchemy.DateTime))
+# Состояние сканирования каждого сайта: адрес MediaWiki API и время последнего успешного обновления
+crawl_state_table = sqlalchemy.Table('crawl_state', metadata, sqlalchemy.Column('site', sqlalchemy.String, primary_key=True), sqlalchemy.Column('api_url', sqlalchemy.String), sqlalchemy.Column('last_run', sqlalchemy.DateTime))
+# Очередь сканирования каждого сайта: переживает падение или Ctrl-C, чтобы обход можно было продолжить
+crawl_frontier_table = sqlalchemy.Table('crawl_frontier', metadata, sqlalchemy.Column('url', sqlalchemy.String, primary_key=True), sqlalchemy.Column('site', sqlalchemy.String, index=True), sqlalchemy.Column('inbound_links', sqlalchemy.Integer, default=0), sqlalchemy.Column('status', sqlalchemy.String), sqlalchemy.Column('last_crawled', sqlalchemy.DateTime))
+# Кэш ответов Gemini и уточненных ключевых слов; answer_cache_sources связывает ответы со статьями для инвалидации
+answer_cache_table = sqlalchemy.Table('answer_cache', metadata, sqlalchemy.Column('key', sqlalchemy.String, primary_key=True), sqlalchemy.Column('kind', sqlalchemy.String), sqlalchemy.Column('value', sqlalchemy.Text), sqlalchemy.Column('created_at', sqlalchemy.Float), sqlalchemy.Column('last_access', sqlalchemy.Float, index=True))
+answer_cache_sources_table = sqlalchemy.Table('answer_cache_sources', metadata, sqlalchemy.Column('cache_key', sqlalchemy.String, index=True), sqlalchemy.Column('article_id', sqlalchemy.Integer, index=True))
+# Статьи, нарезанные на абзацы-пассажи по заголовкам разделов: именно они попадают в промпт.
+# Как и у статей, текст пассажа хранится в text_blobs, а content — наследие старых баз
+wiki_passages_table = sqlalchemy.Table('wiki_passages', metadata, sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True), sqlalchemy.Column('article_id', sqlalchemy.Integer, sqlalchemy.ForeignKey('wiki_articles.id', ondelete='CASCADE'), index=True), sqlalchemy.Column('position', sqlalchemy.Integer), sqlalchemy.Column('title', sqlalchemy.String), sqlalchemy.Column('heading', sqlalchemy.String), sqlalchemy.Column('content', sqlalchemy.Text), sqlalchemy.Column('text_hash', sqlalchemy.String, index=True))
+# Тексты статей и пассажей по одному экземпляру на уникальное содержимое (ключ — SHA-1), сжатые:
+# зеркала вики, форки и перенаправления дают много одинаковых страниц и разделов. size — длина в символах
+text_blobs_table = sqlalchemy.Table('text_blobs', metadata, sqlalchemy.Column('hash', sqlalchemy.String, primary_key=True), sqlalchemy.Column('codec', sqlalchemy.String), sqlalchemy.Column('size', sqlalchemy.Integer), sqlalchemy.Column('data', sqlalchemy.LargeBinary))
 
 # ==============================================================================
 # --- МОДУЛЬ СБОРА ДАННЫХ ---
 # ==============================================================================
 
+# Индексы прежних версий: по целым статьям и по несжатому wiki_passages.content
+FTS_LEGACY_STATEMENTS = [
+    "DROP TRIGGER IF EXISTS wiki_articles_fts_ai", "DROP TRIGGER IF EXISTS wiki_articles_fts_ad", "DROP TRIGGER IF EXISTS wiki_articles_fts_au",
+    "DROP TABLE IF EXISTS wiki_articles_fts",
+    "DROP TRIGGER IF EXISTS wiki_passages_fts_ai", "DROP TRIGGER IF EXISTS wiki_passages_fts_ad", "DROP TRIGGER IF EXISTS wiki_passages_fts_au",
+    "DROP TABLE IF EXISTS wiki_passages_fts",
+]
+# Полнотекстовый индекс FTS5 поверх пассажей (external content): сам текст не дублируется, индекс читает его
+# через представление, распаковывающее text_blobs. Новые пассажи добавляет в индекс insert_passages
+# несжатым текстом, а удаление и изменение отслеживают триггеры. Тексты подчищаются только после удаления
+# пассажей, так что триггер удаления всегда находит старый текст.
+FTS_SETUP_STATEMENTS = [
+    "DROP TRIGGER IF EXISTS wiki_passages_fts_ai",
+    """CREATE VIEW IF NOT EXISTS wiki_passages_text AS
+        SELECT p.id AS id, p.title AS title, p.heading AS heading, blob_text(b.data, b.codec) AS content
+        FROM wiki_passages p LEFT JOIN text_blobs b ON b.hash = p.text_hash""",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS wiki_passages_fts USING fts5(title, heading, content, content='wiki_passages_text', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    """CREATE TRIGGER IF NOT EXISTS wiki_passages_fts_ad AFTER DELETE ON wiki_passages BEGIN
+        INSERT INTO wiki_passages_fts(wiki_passages_fts, rowid, title, heading, content) VALUES ('delete', old.id, old.title, old.heading, (SELECT blob_text(data, codec) FROM text_blobs WHERE hash = old.text_hash));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS wiki_passages_fts_au AFTER UPDATE ON wiki_passages BEGIN
+        INSERT INTO wiki_passages_fts(wiki_passages_fts, rowid, title, heading, content) VALUES ('delete', old.id, old.title, old.heading, (SELECT blob_text(data, codec) FROM text_blobs WHERE hash = old.text_hash));
+        INSERT INTO wiki_passages_fts(rowid, title, heading, content) VALUES (new.id, new.title, new.heading, (SELECT blob_text(data, codec) FROM text_blobs WHERE hash = new.text_hash));
+    END""",
+]
+FTS_AVAILABLE = True
+
 def setup_database():
-    metadata.create_all(engine)
+    global FTS_AVAILABLE
+    metadata.create_all(get_engine())
+    with get_engine().begin() as connection:
+        # create_all не меняет существующие таблицы: колонки text_hash в старых базах добавляем сами
+        for table in (wiki_articles_table, wiki_passages_table):
+            columns = {row[1] for row in connection.execute(text(f"PRAGMA table_info({table.name})"))}
+            if 'text_hash' not in columns: connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN text_hash VARCHAR"))
+            for index in table.indexes: index.create(connection, checkfirst=True)
+        fts_sql = connection.execute(text("SELECT sql FROM sqlite_master WHERE name = 'wiki_passages_fts'")).scalar()
+        if fts_sql is None or 'wiki_passages_text' not in fts_sql:
+            for statement in FTS_LEGACY_STATEMENTS: connection.execute(text(statement))
+        # Статьи, сохраненные до появления пассажей, нарезаем по абзацам (заголовков в них уже нет)
+        legacy_articles = connection.execute(text("SELECT id, title, content FROM wiki_articles WHERE id NOT IN (SELECT DISTINCT article_id FROM wiki_passages)")).fetchall()
+        for article_id, title, content in legacy_articles:
+            replace_passages(connection, article_id, title, [("", content or "")])
+        migrated = migrate_legacy_texts(connection)
+    if migrated:
+        # Место, освобожденное несжатыми текстами, возвращается системе только после VACUUM
+        with get_engine().connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            connection.execute(text("VACUUM"))
+    try:
+        with get_engine().begin() as connection:
+            for statement in FTS_SETUP_STATEMENTS: connection.execute(text(statement))
+            # Пассажи появились раньше индекса: один раз строим его по существующим данным
+            indexed = connection.execute(text("SELECT count(*) FROM wiki_passages_fts_docsize")).scalar()
+            total = connection.execute(text("SELECT count(*) FROM wiki_passages")).scalar()
+            if indexed != total:
+                connection.execute(text("INSERT INTO wiki_passages_fts(wiki_passages_fts) VALUES ('rebuild')"))
+    except sqlalchemy.exc.OperationalError as e:
+        FTS_AVAILABLE = False
+        console.print(f"[yellow]SQLite собран без FTS5 ({e}). Поиск будет работать медленнее.[/yellow]")
+
+# Максимальная длина одного пассажа в символах
+PASSAGE_MAX_CHARS = 1200
+SECTION_HEADING_TAGS = {'h2', 'h3', 'h4'}
+
+def extract_sections(content_div):
+    """Делит текст статьи (дерево BeautifulSoup) на разделы по заголовкам h2-h4: [(заголовок, текст), ...]."""
+    from bs4 import NavigableString, Comment
+    sections = [("", [])]
+    for element in content_div.children:
+        if isinstance(element, Comment): continue
+        if isinstance(element, NavigableString):
+            text_part = str(element).strip()
+        elif element.name in SECTION_HEADING_TAGS or 'mw-heading' in (element.get('class') or []):
+            for edit_link in element.select('.mw-editsection'): edit_link.decompose()
+            sections.append((element.get_text(' ', strip=True), []))
+            continue
+        else:
+            text_part = element.get_text(separator='\n', strip=True)
+        if text_part: sections[-1][1].append(text_part)
+    return [(heading, '\n'.join(parts)) for heading, parts in sections if parts]
+
+@functools.cache
+def load_lxml_html():
+    """lxml.html или None, если lxml не установлен. Импортируется при первом разборе страницы (в каждом процессе пула)."""
+    try:
+        import lxml.html
+        return lxml.html
+    except ImportError:
+        return None
+
+def _lxml_text(element):
+    return '\n'.join(part.strip() for part in element.itertext() if part.strip())
+
+def extract_sections_lxml(content_div):
+    """То же, что extract_sections, для дерева lxml: текст между тегами хранится в .text и .tail."""
+    sections = [("", [])]
+    if content_div.text and content_div.text.strip(): sections[-1][1].append(content_div.text.strip())
+    for element in content_div:
+        if not isinstance(element.tag, str):
+            pass
+        elif element.tag in SECTION_HEADING_TAGS or 'mw-heading' in (element.get('class') or '').split():
+            for edit_link in element.find_class('mw-editsection'): edit_link.drop_tree()
+            sections.append((' '.join(element.text_content().split()), []))
+        else:
+            text_part = _lxml_text(element)
+            if text_part: sections[-1][1].append(text_part)
+        if element.tail and element.tail.strip(): sections[-1][1].append(element.tail.strip())
+    return [(heading, '\n'.join(parts)) for heading, parts in sections if parts]
+
+def split_into_passages(sections, max_chars=PASSAGE_MAX_CHARS):
+    """Режет разделы на пассажи не длиннее max_chars, по возможности не разрывая строки."""
+    passages = []
+    for heading, body in sections:
+        current = ""
+        for line in body.split('\n'):
+            while len(line) > max_chars:
+                cut = line.rfind(' ', 0, max_chars)
+                if cut <= 0: cut = max_chars
+                if current: passages.append((heading, current)); current = ""
+                passages.append((heading, line[:cut])); line = line[cut:].strip()
+            if current and len(current) + len(line) + 1 > max_chars:
+                passages.append((heading, current)); current = line
+            elif line:
+                current = f"{current}\n{line}" if current else line
+        if current: passages.append((heading, current))
+    return passages
+
+def passage_rows(article_id, title, sections):
+    """Пассажи статьи: [(строка wiki_passages, текст), ...]. Тексты сохраняются отдельно через store_texts."""
+    return [(dict(article_id=article_id, position=i, title=title, heading=heading, text_hash=text_hash(body)), body) for i, (heading, body) in enumerate(split_into_passages(sections))]
+
+def insert_passages(connection, rows, index=True):
+    """Вставляет пассажи [(строка, текст), ...] и, если index, сразу добавляет их в индекс FTS готовым текстом:
+    так индексу не нужно распаковывать только что сжатое."""
+    if not rows: return
+    store_texts(connection, [body for _, body in rows], [row['text_hash'] for row, _ in rows])
+    connection.execute(sqlalchemy.insert(wiki_passages_table), [row for row, _ in rows])
+    if index:
+        # RETURNING при executemany в SQLite выполняется построчно, поэтому id новых пассажей читаем одним запросом
+        passages = wiki_passages_table.c
+        passage_ids = {(article_id, position): passage_id for passage_id, article_id, position in connection.execute(
+            sqlalchemy.select(passages.id, passages.article_id, passages.position).where(passages.article_id.in_({row['article_id'] for row, _ in rows})))}
+        connection.execute(text("INSERT INTO wiki_passages_fts(rowid, title, heading, content) VALUES (:id, :title, :heading, :content)"),
+                           [dict(id=passage_ids[row['article_id'], row['position']], title=row['title'], heading=row['heading'], content=body) for row, body in rows])
+
+def replace_passages(connection, article_id, title, sections):
+    """Перезаписывает пассажи статьи в рамках открытой транзакции. Используется при миграции старых баз,
+    до настройки индекса: setup_database потом перестраивает его целиком."""
+    old_hashes = connection.execute(sqlalchemy.select(wiki_passages_table.c.text_hash).where(wiki_passages_table.c.article_id == article_id)).scalars().all()
+    connection.execute(sqlalchemy.delete(wiki_passages_table).where(wiki_passages_table.c.article_id == article_id))
+    insert_passages(connection, passage_rows(article_id, title, sections), index=False)
+    release_texts(connection, old_hashes)
+
+# ------------------------------------------------------------------------------
+# Хранилище текстов: сжатие, дедупликация по хэшу и ленивая распаковка
+# ------------------------------------------------------------------------------
+
+# Уровни сжатия: на коротких текстах более высокие почти не уменьшают размер, но замедляют запись
+TEXT_ZLIB_LEVEL = 3
+TEXT_ZSTD_LEVEL = 10
+# Сколько хэшей подставлять в один IN (...), чтобы не упереться в лимит параметров SQLite
+TEXT_HASH_CHUNK = 500
+
+def text_hash(value):
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+def compress_text(value):
+    """Сжимает текст zstd (если установлен zstandard) или zlib. Короткие тексты, которые не сжимаются, хранятся как есть.
+    Возвращает (кодек, байты)."""
+    raw = value.encode('utf-8')
+    if zstandard is not None:
+        codec, data = 'zstd', zstandard.ZstdCompressor(level=TEXT_ZSTD_LEVEL).compress(raw)
+    else:
+        codec, data = 'zlib', zlib.compress(raw, TEXT_ZLIB_LEVEL)
+    return (codec, data) if len(data) < len(raw) else ('raw', raw)
+
+def decompress_text(data, codec):
+    if data is None: return None
+    if codec == 'zlib': data = zlib.decompress(data)
+    elif codec == 'zstd':
+        if zstandard is None: raise RuntimeError("База содержит тексты, сжатые zstd: установите пакет zstandard")
+        data = zstandard.ZstdDecompressor().decompress(data)
+    return data.decode('utf-8')
+
+def store_texts(connection, texts, hashes=None):
+    """Сохраняет тексты в text_blobs: уже известные (по хэшу) не сжимаются и не пишутся повторно.
+    hashes — уже посчитанные хэши тех же текстов, чтобы не считать их второй раз."""
+    by_hash = dict(zip(hashes or map(text_hash, texts), texts))
+    hashes = list(by_hash)
+    for start in range(0, len(hashes), TEXT_HASH_CHUNK):
+        for known_hash in connection.execute(sqlalchemy.select(text_blobs_table.c.hash).where(text_blobs_table.c.hash.in_(hashes[start:start + TEXT_HASH_CHUNK]))).scalars():
+            del by_hash[known_hash]
+    if not by_hash: return
+    rows = []
+    for hash_value, value in by_hash.items():
+        codec, data = compress_text(value)
+        rows.append(dict(hash=hash_value, codec=codec, size=len(value), data=data))
+    connection.execute(sqlalchemy.dialects.sqlite.insert(text_blobs_table).on_conflict_do_nothing(index_elements=['hash']), rows)
+
+def release_texts(connection, hashes):
+    """Удаляет из text_blobs тексты с этими хэшами, если на них больше не ссылаются ни статьи, ни пассажи.
+    Вызывается после удаления пассажей, чтобы триггер индекса успел прочитать старый текст."""
+    hashes = list({hash_value for hash_value in hashes if hash_value})
+    blobs = text_blobs_table.c
+    for start in range(0, len(hashes), TEXT_HASH_CHUNK):
+        connection.execute(sqlalchemy.delete(text_blobs_table).where(
+            blobs.hash.in_(hashes[start:start + TEXT_HASH_CHUNK]),
+            ~sqlalchemy.exists().where(wiki_passages_table.c.text_hash == blobs.hash),
+            ~sqlalchemy.exists().where(wiki_articles_table.c.text_hash == blobs.hash)))
+
+def migrate_legacy_texts(connection):
+    """Переносит несжатые тексты из колонок content старых баз в text_blobs. Возвращает число перенесенных строк."""
+    migrated = 0
+    for table in (wiki_articles_table, wiki_passages_table):
+        rows = connection.execute(sqlalchemy.select(table.c.id, table.c.content).where(table.c.content.is_not(None))).all()
+        if not rows: continue
+        store_texts(connection, [content for _, content in rows])
+        connection.execute(sqlalchemy.update(table).where(table.c.id == sqlalchemy.bindparam('row_id')).values(text_hash=sqlalchemy.bindparam('new_hash'), content=None),
+                           [dict(row_id=row_id, new_hash=text_hash(content)) for row_id, content in rows])
+        migrated += len(rows)
+    if migrated: console.print(f"[green]Тексты {migrated} статей и пассажей перенесены в сжатое хранилище.[/green]")
+    return migrated
 
 def truncate_text(text, max_length=50):
     return (text[:max_length-3] + "...") if len(text) > max_length else text
 
-def create_layout() -> Layout:
+def create_layout():
+    from rich.layout import Layout
     layout = Layout(name="root")
     layout.split(Layout(Panel("SS14 Helper - Обновление Базы", style="bold blue"), name="header", size=3), Layout(name="main"))
     return layout
 
 def fetch_servers_with_progress(progress, task_id):
+    import requests
     progress.update(task_id, description="[cyan]Получение списка серверов...[/cyan]")
     try:
-        response = requests.get('https://central.spacestation14.io/hub/api/servers', timeout=15); response.raise_for_status(); servers_data = response.json()
-        with engine.connect() as connection:
-            trans = connection.begin()
-            for server in servers_data:
-                server_address = server.get('address')
-                if not server_address: continue
-                server_name = server.get('name', f"Безымянный сервер ({server_address[:20]}...)"); server_players = server.get('players', 0)
-                update_stmt = sqlalchemy.update(servers_table).where(servers_table.c.address == server_address).values(name=server_name, players_online=server_players)
-                result = connection.execute(update_stmt)
-                if result.rowcount == 0:
-                    insert_stmt = sqlalchemy.insert(servers_table).values(name=server_name, address=server_address, players_online=server_players)
-                    connection.execute(insert_stmt)
-            trans.commit()
-        progress.update(task_id, completed=1, description=f"[green]Список серверов обновлен ({len(servers_data)} шт.)[/green]")
+        with STAGE_TIMINGS.span('servers.fetch'):
+            response = requests.get(SERVERS_HUB_URL, timeout=15); response.raise_for_status(); servers_data = response.json()
+        server_rows = {}
+        for server in servers_data:
+            server_address = server.get('address')
+            if not server_address: continue
+            server_name = server.get('name', f"Безымянный сервер ({server_address[:20]}...)"); server_players = server.get('players', 0)
+            server_rows[server_address] = dict(name=server_name, address=server_address, players_online=server_players)
+        # Весь список одним executemany с ON CONFLICT вместо UPDATE + INSERT на каждый сервер
+        started = time.perf_counter()
+        with get_engine().begin() as connection:
+            stmt = sqlalchemy.dialects.sqlite.insert(servers_table)
+            stmt = stmt.on_conflict_do_update(index_elements=['address'], set_=dict(name=stmt.excluded.name, players_online=stmt.excluded.players_online, last_seen=sqlalchemy.func.now()))
+            if server_rows: connection.execute(stmt, list(server_rows.values()))
+        STAGE_TIMINGS.record('servers.write', time.perf_counter() - started)
+        rate = len(server_rows) / max(time.perf_counter() - started, 1e-6)
+        progress.update(task_id, completed=1, description=f"[green]Список серверов обновлен ({len(servers_data)} шт., {rate:.0f} зап/с)[/green]")
     except Exception as e:
         progress.update(task_id, description=f"[red]Ошибка получения серверов: {e}[/red]")
 
-def scrape_and_find_links(url):
+CRAWLER_HEADERS = {'User-Agent': 'Mozilla/5.0 (My SS14 Helper Bot)'}
+CRAWLER_SKIP_MARKERS = [':Special:', ':File:', '.png', '.jpg', 'action=edit']
+
+class TokenBucket:
+    """Ограничивает частоту запросов: не больше rate в секунду, с запасом на burst запросов."""
+    def __init__(self, rate, burst):
+        self.rate = float(rate); self.capacity = max(1.0, float(burst)); self.tokens = self.capacity
+        self.updated = time.monotonic(); self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0: return
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate); self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class HostLimiter:
+    """Правила вежливости для каждого хоста: лимит одновременных запросов и token bucket."""
+    def __init__(self, concurrency, rate):
+        self.concurrency = max(1, int(concurrency)); self.rate = rate; self.hosts = {}
+
+    @contextlib.asynccontextmanager
+    async def slot(self, url):
+        netloc = urlparse(url).netloc
+        if netloc not in self.hosts:
+            self.hosts[netloc] = (asyncio.Semaphore(self.concurrency), TokenBucket(self.rate, self.concurrency))
+        semaphore, bucket = self.hosts[netloc]
+        async with semaphore:
+            await bucket.acquire()
+            yield
+
+def utc_now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def load_validators(base_netloc):
+    """Загружает валидаторы всех известных страниц сайта: {url: строка page_validators}."""
+    with get_engine().connect() as connection:
+        rows = connection.execute(sqlalchemy.select(page_validators_table).where(page_validators_table.c.source.like(f"%://{base_netloc}/%"))).mappings().all()
+    return {row['source']: row for row in rows}
+
+def load_crawl_state(site):
+    with get_engine().connect() as connection:
+        return connection.execute(sqlalchemy.select(crawl_state_table).where(crawl_state_table.c.site == site)).mappings().first()
+
+def save_crawl_state(site, api_url, last_run):
+    with get_engine().begin() as connection:
+        stmt = sqlalchemy.dialects.sqlite.insert(crawl_state_table).values(site=site, api_url=api_url, last_run=last_run)
+        connection.execute(stmt.on_conflict_do_update(index_elements=['site'], set_=dict(api_url=api_url, last_run=last_run)))
+
+class CrawlContext:
+    """Общие ресурсы одного обновления: HTTP-сессия, ограничитель вежливости, пул процессов для разбора HTML
+    и единственная стадия записи в БД."""
+    def __init__(self, session, limiter, parse_pool=None, writer=None):
+        self.session = session; self.limiter = limiter; self.parse_pool = parse_pool; self.writer = writer
+
+    async def parse(self, html, encoding=None):
+        """Разбирает HTML в пуле процессов (или в потоке, если пул отключен), не блокируя загрузку."""
+        if self.parse_pool is None:
+            article, seconds = await asyncio.to_thread(scrape_timed, html, encoding)
+        else:
+            article, seconds = await asyncio.get_running_loop().run_in_executor(self.parse_pool, scrape_timed, html, encoding)
+        STAGE_TIMINGS.record('crawl.parse', seconds)
+        return article
+
+async def fetch_page(crawl, url, known=None):
+    """Скачивает страницу через общий пул keep-alive соединений, отправляя условные заголовки,
+    если страница уже известна. Возвращает (статус, сырой HTML в байтах, кодировка из Content-Type, ETag, Last-Modified);
+    при сетевой ошибке статус None."""
+    headers = {}
+    if known:
+        if known['etag']: headers['If-None-Match'] = known['etag']
+        if known['last_modified']: headers['If-Modified-Since'] = known['last_modified']
+    async with crawl.limiter.slot(url):
+        with STAGE_TIMINGS.span('crawl.fetch'):
+            try:
+                async with crawl.session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                    if response.status != 200: return response.status, None, None, None, None
+                    return 200, await response.read(), response.charset, response.headers.get('ETag'), response.headers.get('Last-Modified')
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                return None, None, None, None, None
+
+META_CHARSET_RE = re.compile(rb'<meta[^>]+charset=["\']?([\w-]+)', re.IGNORECASE)
+
+def sniff_encoding(html, encoding=None):
+    """Кодировка страницы: из заголовка Content-Type, иначе из <meta charset>, иначе UTF-8."""
+    if not encoding:
+        match = META_CHARSET_RE.search(html[:4096])
+        encoding = match.group(1).decode('ascii') if match else 'utf-8'
     try:
-        headers = {'User-Agent': 'Mozilla/5.0 (My SS14 Helper Bot)'}; response = requests.get(url, timeout=10, headers=headers); response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'html.parser'); title_element = soup.find(id='firstHeading'); content_div = soup.find('div', class_='mw-parser-output')
-        if not title_element or not content_div: return None, []
-        title = title_element.get_text(); content = content_div.get_text(separator='\n', strip=True)
-        with engine.connect() as connection:
-            trans = connection.begin()
-            stmt = sqlalchemy.dialects.sqlite.insert(wiki_articles_table).values(title=title, content=content, source=url).on_conflict_do_update(index_elements=['source'], set_=dict(title=title, content=content))
-            connection.execute(stmt); trans.commit()
-        return title, [link['href'] for link in content_div.find_all('a', href=True)]
-    except requests.RequestException:
-        return None, []
-
-def run_crawler_with_progress(progress, task_id, start_url):
+        return codecs.lookup(encoding).name
+    except LookupError:
+        return 'utf-8'
+
+def scrape_and_find_links(html, encoding=None):
+    """Извлекает из сырого HTML заголовок, текст, разделы и ссылки статьи. Выполняется в пуле процессов,
+    поэтому не трогает БД. Возвращает словарь или None, если это не статья."""
+    lxml_html = load_lxml_html()
+    if lxml_html is not None:
+        # Быстрый путь: lxml и точечные селекторы вместо обхода всего дерева BeautifulSoup
+        try:
+            root = lxml_html.fromstring(html, parser=lxml_html.HTMLParser(encoding=sniff_encoding(html, encoding)))
+        except (ValueError, lxml_html.etree.ParserError):
+            return None
+        title_element = root.get_element_by_id('firstHeading', None)
+        content_nodes = root.find_class('mw-parser-output')
+        if title_element is None or not content_nodes: return None
+        content_div = content_nodes[0]
+        for element in content_div.xpath('.//script|.//style'): element.drop_tree()
+        article = dict(title=title_element.text_content(), content=_lxml_text(content_div),
+                       links=content_div.xpath('.//a/@href'), sections=extract_sections_lxml(content_div))
+    else:
+        from bs4 import BeautifulSoup
+        soup = BeautifulSoup(html, 'html.parser', from_encoding=sniff_encoding(html, encoding)); title_element = soup.find(id='firstHeading'); content_div = soup.find('div', class_='mw-parser-output')
+        if not title_element or not content_div: return None
+        # Как и в пути lxml: без скриптов и стилей, а текст по обе стороны от них склеивается
+        for element in content_div.find_all(['script', 'style']): element.decompose()
+        content_div.smooth()
+        article = dict(title=title_element.get_text(), content=content_div.get_text(separator='\n', strip=True),
+                       links=[link['href'] for link in content_div.find_all('a', href=True)], sections=extract_sections(content_div))
+    article['links_json'] = json.dumps(article['links'], ensure_ascii=False)
+    article['content_hash'] = hashlib.sha1(f"{article['title']}\0{article['content']}\0{article['links_json']}".encode('utf-8')).hexdigest()
+    return article
+
+def scrape_timed(html, encoding=None):
+    """scrape_and_find_links для пула процессов: время разбора возвращается вместе с результатом,
+    потому что замеры в дочернем процессе до основного не доходят."""
+    started = time.perf_counter()
+    return scrape_and_find_links(html, encoding), time.perf_counter() - started
+
+def prepare_article_write(url, article, known=None, etag=None, last_modified=None):
+    """Сравнивает разобранную статью с сохраненной версией. Возвращает (результат, запись для BatchWriter),
+    где результат — 'updated' или 'unchanged', а запись None, если писать в БД нечего."""
+    changed = not known or known['content_hash'] != article['content_hash']
+    if not changed and known['etag'] == etag and known['last_modified'] == last_modified: return 'unchanged', None
+    validators = dict(etag=etag, last_modified=last_modified, content_hash=article['content_hash'], links=article['links_json'], last_checked=utc_now())
+    return ('updated' if changed else 'unchanged'), dict(url=url, article=article if changed else None, validators=validators)
+
+def upsert_frontier_rows(connection, rows):
+    stmt = sqlalchemy.dialects.sqlite.insert(crawl_frontier_table)
+    stmt = stmt.on_conflict_do_update(index_elements=['url'], set_=dict(inbound_links=stmt.excluded.inbound_links, status=stmt.excluded.status, last_crawled=stmt.excluded.last_crawled))
+    connection.execute(stmt, rows)
+
+# Размер пачки и максимальная задержка записи в BatchWriter
+WRITER_BATCH_SIZE = 100
+WRITER_FLUSH_INTERVAL = 1.0
+
+class BatchWriter:
+    """Единственная стадия записи обновления: копит upsert'ы статей, пассажей, валидаторов и очереди
+    сканирования и сбрасывает их пачками через executemany в одной транзакции. Считает скорость записи."""
+    def __init__(self, batch_size=WRITER_BATCH_SIZE, flush_interval=WRITER_FLUSH_INTERVAL):
+        self.batch_size = batch_size; self.flush_interval = flush_interval
+        self.pending_articles = []; self.pending_frontier = []
+        self.rows_written = 0; self.write_seconds = 0.0
+        self.lock = asyncio.Lock(); self.timer = None; self.in_flight = None
+
+    def start(self):
+        self.timer = asyncio.create_task(self._flush_periodically())
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def add(self, write):
+        self.pending_articles.append(write)
+        # Ожидание сброса заодно притормаживает загрузку, если БД не успевает
+        if len(self.pending_articles) >= self.batch_size: await self.flush()
+
+    def add_frontier(self, rows):
+        self.pending_frontier.extend(rows)
+
+    async def flush(self):
+        async with self.lock:
+            # Запись, чей ожидающий был отменен, могла еще не закончиться: две записи одновременно не идут
+            if self.in_flight: await asyncio.wait([self.in_flight])
+            articles, self.pending_articles = self.pending_articles, []
+            frontier_rows, self.pending_frontier = self.pending_frontier, []
+            if articles or frontier_rows:
+                # Отмена ждущей задачи не должна терять уже забранную пачку: запись в потоке доводится до конца,
+                # а close() дожидается ее перед своей
+                self.in_flight = asyncio.ensure_future(asyncio.to_thread(self._write, articles, frontier_rows))
+                await asyncio.shield(self.in_flight)
+
+    async def close(self):
+        """Останавливает таймер, дожидается начатой записи и синхронно дописывает остаток (в том числе при отмене по Ctrl-C)."""
+        if self.timer:
+            self.timer.cancel()
+            await asyncio.gather(self.timer, return_exceptions=True)
+        async with self.lock:
+            if self.in_flight: await asyncio.wait([self.in_flight])
+            articles, self.pending_articles = self.pending_articles, []
+            frontier_rows, self.pending_frontier = self.pending_frontier, []
+            if articles or frontier_rows: self._write(articles, frontier_rows)
+
+    @property
+    def rate(self):
+        return self.rows_written / self.write_seconds if self.write_seconds else 0.0
+
+    def _write(self, articles, frontier_rows):
+        started = time.perf_counter(); rows_count = 0
+        latest = {write['url']: write for write in articles}
+        with get_engine().begin() as connection:
+            changed = {url: write['article'] for url, write in latest.items() if write['article']}
+            if changed:
+                # Прежние тексты статей: после перезаписи ненужные из них удаляются
+                old_hashes = connection.execute(sqlalchemy.select(wiki_articles_table.c.text_hash).where(wiki_articles_table.c.source.in_(list(changed)))).scalars().all()
+                store_texts(connection, [article['content'] for article in changed.values()])
+                stmt = sqlalchemy.dialects.sqlite.insert(wiki_articles_table)
+                stmt = stmt.on_conflict_do_update(index_elements=['source'], set_=dict(title=stmt.excluded.title, text_hash=stmt.excluded.text_hash, content=None, last_updated=sqlalchemy.func.now()))
+                connection.execute(stmt, [dict(source=url, title=article['title'], text_hash=text_hash(article['content'])) for url, article in changed.items()])
+                article_ids = dict(connection.execute(sqlalchemy.select(wiki_articles_table.c.source, wiki_articles_table.c.id).where(wiki_articles_table.c.source.in_(list(changed)))).all())
+                # Пассажи, которые не изменились, остаются на месте: удаление из индекса FTS стоит распаковки старого текста
+                passages = wiki_passages_table.c
+                old_passages = {(row.article_id, row.position, row.title, row.heading, row.text_hash): (row.id, row.text_hash) for row in connection.execute(
+                    sqlalchemy.select(passages.id, passages.article_id, passages.position, passages.title, passages.heading, passages.text_hash).where(passages.article_id.in_(list(article_ids.values()))))}
+                new_passages = []
+                for url, article in changed.items():
+                    for row, body in passage_rows(article_ids[url], article['title'], article['sections']):
+                        if old_passages.pop((row['article_id'], row['position'], row['title'], row['heading'], row['text_hash']), None) is None: new_passages.append((row, body))
+                if old_passages:
+                    connection.execute(sqlalchemy.delete(wiki_passages_table).where(passages.id.in_([passage_id for passage_id, _ in old_passages.values()])))
+                    old_hashes += [hash_value for _, hash_value in old_passages.values()]
+                insert_passages(connection, new_passages, index=FTS_AVAILABLE)
+                release_texts(connection, old_hashes)
+                # Ответы, построенные на старых версиях этих статей, больше не годятся
+                ANSWER_CACHE.invalidate_articles(connection, list(article_ids.values()))
+                rows_count += len(changed) + len(old_passages) + len(new_passages)
+            if latest:
+                stmt = sqlalchemy.dialects.sqlite.insert(page_validators_table)
+                stmt = stmt.on_conflict_do_update(index_elements=['source'], set_={column: stmt.excluded[column] for column in ('etag', 'last_modified', 'content_hash', 'links', 'last_checked')})
+                connection.execute(stmt, [dict(source=url, **write['validators']) for url, write in latest.items()])
+                rows_count += len(latest)
+            if frontier_rows:
+                upsert_frontier_rows(connection, frontier_rows)
+                rows_count += len(frontier_rows)
+        self.rows_written += rows_count; self.write_seconds += time.perf_counter() - started
+        STAGE_TIMINGS.record('crawl.db_write', time.perf_counter() - started)
+
+async def process_page(crawl, url, validators):
+    """Обновляет одну страницу: загрузка, разбор в пуле процессов, запись. Неизменившаяся страница стоит
+    ответа 304 и не пишет в БД, а ее ссылки берутся из сохраненных валидаторов. Возвращает (результат, ссылки);
+    результат 'failed' — временная ошибка (сеть, 429, 5xx), None — страница не статья или ее больше нет."""
+    known = validators.get(url)
+    status, html, encoding, etag, last_modified = await fetch_page(crawl, url, known)
+    if status == 304 and known: return 'unchanged', json.loads(known['links'] or '[]')
+    if html is None: return ('failed' if status is None or status == 429 or status >= 500 else None), []
+    article = await crawl.parse(html, encoding)
+    if article is None: return None, []
+    result, write = prepare_article_write(url, article, known, etag, last_modified)
+    if write: await crawl.writer.add(write)
+    return result, article['links']
+
+def normalize_url(url):
+    """Приводит URL к каноническому виду: без фрагмента и порта по умолчанию, хост в нижнем регистре,
+    единое percent-кодирование пути и отсортированные параметры запроса."""
+    parts = urlsplit(url)
+    scheme, netloc = parts.scheme.lower(), parts.netloc.lower()
+    if (scheme, netloc.rpartition(':')[2]) in (('http', '80'), ('https', '443')): netloc = netloc.rpartition(':')[0]
+    path = quote(unquote(parts.path), safe="/:@!$&'()*+,;=-._~") or '/'
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, path, query, ''))
+
+# Приоритет страницы: число входящих ссылок + вес за каждый день с последнего сканирования
+FRONTIER_STALENESS_WEIGHT = 2.0
+# Насколько "устаревшей" считается страница, которую еще ни разу не сканировали
+FRONTIER_NEVER_CRAWLED_DAYS = 7
+# Как часто (в обработанных страницах) сбрасывать изменения очереди в БД
+FRONTIER_FLUSH_EVERY = 25
+
+class CrawlFrontier:
+    """Очередь сканирования одного сайта с приоритетами, сохраняемая в crawl_frontier.
+
+    Статусы: 'pending' — ждет обработки в текущем обходе, 'done' — обработана в нем,
+    'idle' — известна по прошлым обходам. Если при старте есть 'pending', обход прерывался и продолжается.
+    """
+    def __init__(self, site):
+        self.site = site; self.entries = {}; self.run_inbound = defaultdict(int)
+        self.heap = []; self.taken = set(); self.dirty = set()
+
+    def load(self, start_url):
+        """Загружает очередь из БД (вызывается в отдельном потоке). Возвращает True, если обход возобновлен."""
+        frontier = crawl_frontier_table.c
+        with get_engine().connect() as connection:
+            rows = connection.execute(sqlalchemy.select(crawl_frontier_table, wiki_articles_table.c.id.label('article_id'))
+                                      .select_from(crawl_frontier_table.outerjoin(wiki_articles_table, wiki_articles_table.c.source == frontier.url))
+                                      .where(frontier.site == self.site)).mappings().all()
+        resuming = any(row['status'] == 'pending' for row in rows)
+        for row in rows:
+            entry = self.entries[row['url']] = dict(inbound_links=row['inbound_links'] or 0, status=row['status'], last_crawled=row['last_crawled'])
+            # Страница без статьи могла быть отмечена 'done' до того, как ее статья дошла до БД: при продолжении обходим ее снова
+            if not resuming or (row['status'] == 'done' and row['article_id'] is None):
+                entry['status'] = 'pending'; self.dirty.add(row['url'])
+        if start_url not in self.entries:
+            self.entries[start_url] = dict(inbound_links=0, status='pending', last_crawled=None); self.dirty.add(start_url)
+        self.now = utc_now()
+        for url, entry in self.entries.items():
+            if entry['status'] == 'pending': self._push(url)
+        # Новый обход всегда начинается со стартовой страницы
+        if not resuming: heapq.heappush(self.heap, (float('-inf'), start_url))
+        return resuming
+
+    def _push(self, url):
+        entry = self.entries[url]
+        last_crawled = entry['last_crawled']
+        staleness = FRONTIER_NEVER_CRAWLED_DAYS if last_crawled is None else (self.now - last_crawled).total_seconds() / 86400
+        heapq.heappush(self.heap, (-(entry['inbound_links'] + FRONTIER_STALENESS_WEIGHT * staleness), url))
+
+    def add_link(self, url):
+        """Учитывает ссылку на url с очередной страницы. Дубликаты отсекаются по словарю за O(1)."""
+        entry = self.entries.get(url)
+        if entry is None:
+            entry = self.entries[url] = dict(inbound_links=0, status='pending', last_crawled=None)
+        self.run_inbound[url] += 1
+        # Счетчик прошлого обхода остается оценкой снизу, пока в текущем ссылок не набралось больше
+        if self.run_inbound[url] > entry['inbound_links']:
+            entry['inbound_links'] = self.run_inbound[url]; self.dirty.add(url)
+        if entry['status'] == 'pending' and url not in self.taken:
+            self._push(url)
+
+    def pop(self):
+        while self.heap:
+            _, url = heapq.heappop(self.heap)
+            if url not in self.taken and self.entries[url]['status'] == 'pending':
+                self.taken.add(url)
+                return url
+        return None
+
+    def mark_done(self, url):
+        entry = self.entries[url]
+        entry['status'] = 'done'; entry['last_crawled'] = utc_now(); self.dirty.add(url)
+
+    def finish(self):
+        """Обход завершен штатно: все известные страницы переходят в 'idle' до следующего обхода."""
+        for url, entry in self.entries.items():
+            if entry['status'] != 'idle': entry['status'] = 'idle'; self.dirty.add(url)
+
+    def take_dirty(self):
+        rows = [dict(url=url, site=self.site, **self.entries[url]) for url in self.dirty]
+        self.dirty = set()
+        return rows
+
+async def run_crawler_with_progress(crawl, progress, task_id, start_url):
     max_pages = SETTINGS.get("max_pages_per_crawl", 50)
+    workers_count = max(1, int(SETTINGS.get("crawler_concurrency_per_host", 4)))
+    start_url = normalize_url(start_url)
+    base_netloc = urlparse(start_url).netloc
+    frontier = CrawlFrontier(base_netloc)
+    resuming = await asyncio.to_thread(frontier.load, start_url)
+    if resuming: progress.update(task_id, description=f"[cyan]Продолжаю прерванный обход {base_netloc}...[/cyan]")
+    validators = await asyncio.to_thread(load_validators, base_netloc)
+    pages_count = unchanged_count = processed_count = in_flight = 0
+    work_changed = asyncio.Condition()
+
+    async def next_url():
+        nonlocal in_flight
+        async with work_changed:
+            while pages_count < max_pages:
+                current_url = frontier.pop()
+                if current_url:
+                    in_flight += 1
+                    return current_url
+                # Очередь пуста: если никто больше не обрабатывает страницы, новых ссылок не будет
+                if in_flight == 0: return None
+                await work_changed.wait()
+            return None
+
+    async def worker():
+        nonlocal pages_count, unchanged_count, processed_count, in_flight
+        while (current_url := await next_url()) is not None:
+            try:
+                short_url = truncate_text(unquote(current_url.split('/')[-1]), 40)
+                progress.update(task_id, description=f"[cyan]Анализ {base_netloc}:[/cyan] {short_url}")
+                result, found_links = await process_page(crawl, current_url, validators)
+                if result in ('updated', 'unchanged') and pages_count < max_pages:
+                    pages_count += 1
+                    if result == 'unchanged': unchanged_count += 1
+                    progress.advance(task_id)
+                page_links = set()
+                for href in found_links:
+                    full_url = normalize_url(urljoin(current_url, href))
+                    if urlparse(full_url).netloc != base_netloc: continue
+                    if any(kw in full_url for kw in CRAWLER_SKIP_MARKERS): continue
+                    page_links.add(full_url)
+                for full_url in page_links: frontier.add_link(full_url)
+            except Exception as e:
+                progress.console.log(f"[red]Ошибка обработки {current_url}: {e}[/red]")
+            # При отмене сюда не доходим: страница останется 'pending' и будет обработана при продолжении
+            frontier.mark_done(current_url)
+            processed_count += 1
+            async with work_changed:
+                in_flight -= 1; work_changed.notify_all()
+            if processed_count % FRONTIER_FLUSH_EVERY == 0:
+                crawl.writer.add_frontier(frontier.take_dirty())
+
+    workers = [asyncio.create_task(worker()) for _ in range(workers_count)]
+    try:
+        await asyncio.gather(*workers)
+        frontier.finish()
+    finally:
+        for w in workers: w.cancel()
+        # Очередь уходит в БД и при прерывании (Ctrl-C), чтобы следующий запуск продолжил с того же места
+        crawl.writer.add_frontier(frontier.take_dirty())
+    progress.update(task_id, completed=max_pages, description=f"[green]Анализ {base_netloc} завершен ({pages_count} стр., без изменений {unchanged_count})[/green]")
+
+def has_pending_frontier(site):
+    with get_engine().connect() as connection:
+        return connection.execute(sqlalchemy.select(crawl_frontier_table.c.url).where(crawl_frontier_table.c.site == site, crawl_frontier_table.c.status == 'pending').limit(1)).first() is not None
+
+LINK_TAG_RE = re.compile(rb'<link\b[^>]*>', re.IGNORECASE)
+EDIT_URI_REL_RE = re.compile(rb'\brel\s*=\s*["\']?EditURI\b', re.IGNORECASE)
+HREF_ATTR_RE = re.compile(rb'\bhref\s*=\s*["\']([^"\']+)', re.IGNORECASE)
+
+async def discover_api_url(crawl, start_url):
+    """Находит адрес MediaWiki API по ссылке EditURI на стартовой странице или по стандартным путям."""
+    candidates = []
+    status, html, encoding, _, _ = await fetch_page(crawl, start_url)
+    if html:
+        # Нужен один тег <head>: регулярное выражение вместо разбора всей страницы на event loop
+        for tag in LINK_TAG_RE.findall(html):
+            if not EDIT_URI_REL_RE.search(tag): continue
+            href = HREF_ATTR_RE.search(tag)
+            if href: candidates.append(urljoin(start_url, unescape(href.group(1).decode(sniff_encoding(html, encoding), 'replace'))).split('?')[0]); break
+    candidates += [urljoin(start_url, '/api.php'), urljoin(start_url, '/w/api.php')]
+    for api_url in candidates:
+        async with crawl.limiter.slot(api_url):
+            try:
+                async with crawl.session.get(api_url, params={'action': 'query', 'meta': 'siteinfo', 'format': 'json'}, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                    if response.status == 200 and 'query' in await response.json(content_type=None): return api_url
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                continue
+    return None
+
+async def fetch_recent_changes(crawl, api_url, since):
+    """Спрашивает у MediaWiki API, какие статьи менялись после since. Возвращает множество URL или None при ошибке."""
+    # Небольшой запас на расхождение часов между нами и вики
+    since_str = (since - timedelta(minutes=10)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    params = {'action': 'query', 'format': 'json', 'generator': 'recentchanges', 'grcend': since_str, 'grcnamespace': '0', 'grctype': 'edit|new', 'grctoponly': '1', 'grclimit': 'max', 'prop': 'info', 'inprop': 'url'}
+    changed_urls = set()
+    while True:
+        async with crawl.limiter.slot(api_url):
+            try:
+                async with crawl.session.get(api_url, params=params, timeout=aiohttp.ClientTimeout(total=15)) as response:
+                    if response.status != 200: return None
+                    data = await response.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                return None
+        if 'error' in data: return None
+        changed_urls.update(page['fullurl'] for page in data.get('query', {}).get('pages', {}).values() if 'fullurl' in page)
+        if 'continue' not in data: return changed_urls
+        params.update(data['continue'])
+
+async def run_incremental_update(crawl, progress, task_id, base_netloc, changed_urls):
+    """Обновляет только страницы, изменившиеся с прошлого запуска (без ограничения бюджетом, чтобы не терять правки).
+    Возвращает число страниц, которые не удалось обновить из-за временных ошибок."""
+    changed_urls = [url for url in map(normalize_url, changed_urls) if urlparse(url).netloc == base_netloc]
+    validators = await asyncio.to_thread(load_validators, base_netloc)
+    progress.update(task_id, total=max(1, len(changed_urls)), description=f"[cyan]Изменения {base_netloc}: {len(changed_urls)} стр.[/cyan]")
+    updated_count = failed_count = 0
+
+    async def refresh(url):
+        nonlocal updated_count, failed_count
+        try:
+            result, _ = await process_page(crawl, url, validators)
+            if result == 'updated': updated_count += 1
+            elif result == 'failed': failed_count += 1
+        except Exception as e:
+            failed_count += 1
+            progress.console.log(f"[red]Ошибка обработки {url}: {e}[/red]")
+        progress.advance(task_id)
+
+    await asyncio.gather(*(refresh(url) for url in changed_urls))
+    failed_note = f", ошибок {failed_count}" if failed_count else ""
+    progress.update(task_id, completed=max(1, len(changed_urls)), description=f"[green]{base_netloc}: обновлено {updated_count} из {len(changed_urls)} измененных стр.{failed_note}[/green]")
+    return failed_count
+
+async def crawl_site(crawl, progress, task_id, start_url, full=False):
+    """Обновляет один сайт: инкрементально через recent changes, если это возможно, иначе полным обходом."""
     base_netloc = urlparse(start_url).netloc
-    pages_to_crawl = deque([start_url])
-    crawled_pages = set()
-    pages_count = 0
-    while pages_to_crawl and not progress.tasks[task_id].finished:
-        current_url = pages_to_crawl.popleft()
-        if current_url in crawled_pages: continue
-        decoded_url_part = unquote(current_url.split('/')[-1])
-        short_url = truncate_text(decoded_url_part, 40)
-        progress.update(task_id, description=f"[cyan]Анализ {base_netloc}:[/cyan] {short_url}")
-        crawled_pages.add(current_url)
-        title, found_links = scrape_and_find_links(current_url)
-        if title:
-            pages_count += 1
-            progress.advance(task_id)
-        for href in found_links:
-            full_url = urljoin(current_url, href).split('#')[0]
-            if urlparse(full_url).netloc != base_netloc: continue
-            if any(kw in full_url for kw in [':Special:', ':File:', '.png', '.jpg', 'action=edit']): continue
-            if full_url not in crawled_pages and full_url not in pages_to_crawl:
-                pages_to_crawl.append(full_url)
-        time.sleep(0.1)
-    progress.update(task_id, completed=max_pages, description=f"[green]Анализ {base_netloc} завершен ({pages_count} стр.)[/green]")
-
-def autonomous_update():
-    setup_database()
+    run_started = utc_now()
+    state = await asyncio.to_thread(load_crawl_state, base_netloc)
+    api_url = state['api_url'] if state else None
+    # Прерванный полный обход имеет приоритет: он продолжается с сохраненной очереди
+    resume_pending = await asyncio.to_thread(has_pending_frontier, base_netloc)
+    if not full and not resume_pending and SETTINGS.get("crawler_incremental", True) and state and state['last_run']:
+        progress.update(task_id, description=f"[cyan]Проверка изменений {base_netloc}...[/cyan]")
+        api_url = api_url or await discover_api_url(crawl, start_url)
+        changed_urls = await fetch_recent_changes(crawl, api_url, state['last_run']) if api_url else None
+        if changed_urls is not None:
+            failed_count = await run_incremental_update(crawl, progress, task_id, base_netloc, changed_urls)
+            # Если часть изменений не загрузилась, прежняя отметка остается: в следующий раз они придут снова
+            await asyncio.to_thread(save_crawl_state, base_netloc, api_url, state['last_run'] if failed_count else run_started)
+            return
+    await run_crawler_with_progress(crawl, progress, task_id, start_url)
+    await asyncio.to_thread(save_crawl_state, base_netloc, api_url, run_started)
+
+async def crawl_all_sites(progress, overall_task, start_points, full=False):
+    """Сканирует все стартовые сайты параллельно через одну сессию с общим пулом соединений."""
+    concurrency = max(1, int(SETTINGS.get("crawler_concurrency_per_host", 4)))
+    limiter = HostLimiter(concurrency, SETTINGS.get("crawler_requests_per_second", 5.0))
+    connector = aiohttp.TCPConnector(limit=concurrency * max(1, len(start_points)), limit_per_host=concurrency, ttl_dns_cache=300, keepalive_timeout=30)
+    # Разбор HTML упирается в CPU, поэтому идет в отдельных процессах (0 — по числу ядер)
+    parse_pool = create_parse_pool()
+    writer = BatchWriter(); writer.start()
+    try:
+        async with aiohttp.ClientSession(connector=connector, headers=CRAWLER_HEADERS) as session:
+            crawl_context = CrawlContext(session, limiter, parse_pool, writer)
+            async def crawl(url, crawl_task):
+                await crawl_site(crawl_context, progress, crawl_task, url, full=full)
+                progress.advance(overall_task)
+            max_pages = SETTINGS.get("max_pages_per_crawl", 50)
+            crawls = [crawl(url, progress.add_task(f"Сайт: {urlparse(url).netloc}", total=max_pages)) for url in start_points]
+            await asyncio.gather(*crawls)
+    finally:
+        await writer.close()
+        if parse_pool is not None: parse_pool.shutdown(cancel_futures=True)
+    return writer
+
+def create_parse_pool():
+    """Создает пул процессов для разбора HTML. Если процессы недоступны, разбор пойдет в потоках."""
+    workers = int(SETTINGS.get("parser_workers", 0)) or os.cpu_count() or 1
+    try:
+        return ProcessPoolExecutor(max_workers=workers)
+    except (OSError, NotImplementedError) as e:
+        console.print(f"[yellow]Пул процессов недоступен ({e}), разбор страниц пойдет в потоках.[/yellow]")
+        return None
+
+def autonomous_update(full=False):
+    from rich.live import Live
+    from rich.progress import Progress, SpinnerColumn, BarColumn, TextColumn, TimeElapsedColumn, MofNCompleteColumn
+    started = time.perf_counter()
+    get_engine()
     layout = create_layout()
     progress = Progress(SpinnerColumn(), TextColumn("[progress.description]{task.description}", justify="left"), BarColumn(bar_width=None), MofNCompleteColumn(), TimeElapsedColumn(), console=console)
     layout["main"].update(Panel(progress, title="[yellow]Процесс обновления[/yellow]", border_style="green"))
@@ -242,16 +1156,99 @@ def autonomous_update():
             time.sleep(3); return
         overall_task = progress.add_task("[bold]Общий прогресс[/bold]", total=len(start_points) + 1)
         server_task = progress.add_task("Серверы", total=1)
-        fetch_servers_with_progress(progress, server_task)
+        with STAGE_TIMINGS.span('update.servers'):
+            fetch_servers_with_progress(progress, server_task)
         progress.advance(overall_task)
-        for url in start_points:
-            max_pages = SETTINGS.get("max_pages_per_crawl", 50)
-            crawl_task = progress.add_task(f"Сайт: {urlparse(url).netloc}", total=max_pages)
-            run_crawler_with_progress(progress, crawl_task, url)
-            progress.advance(overall_task)
-        progress.update(overall_task, description="[bold green]Обновление завершено![/bold green]")
+        with STAGE_TIMINGS.span('update.crawl'):
+            writer = asyncio.run(crawl_all_sites(progress, overall_task, start_points, full=full))
+        STAGE_TIMINGS.record('update.total', time.perf_counter() - started); STAGE_TIMINGS.export()
+        progress.update(overall_task, description=f"[bold green]Обновление завершено![/bold green] Записано в БД: {writer.rows_written} строк, {writer.rate:.0f} строк/с")
         time.sleep(2)
 
+# ==============================================================================
+# --- КЭШ ОТВЕТОВ ---
+# ==============================================================================
+
+# Сколько записей держать в памяти перед таблицей answer_cache
+CACHE_MEMORY_ENTRIES = 256
+
+def normalize_query(query):
+    return ' '.join(re.findall(r'\w+', query.lower()))
+
+class AnswerCache:
+    """Кэш ответов Gemini и уточненных ключевых слов: таблица answer_cache в SQLite и LRU-словарь в памяти перед ней.
+
+    Записи живут cache_ttl_hours, таблица ограничена cache_max_entries и вытесняет давно не использованные.
+    Ответы привязаны к статьям, из которых собран контекст, и удаляются, когда паук обновляет эти статьи.
+    """
+    def __init__(self, memory_size=CACHE_MEMORY_ENTRIES):
+        self.memory = OrderedDict(); self.memory_size = memory_size; self.lock = threading.Lock()
+        # Попадания в память копятся здесь и переносятся в last_access перед вытеснением в put()
+        self.touched = {}
+
+    @staticmethod
+    def make_key(kind, query, server_context="all", context=""):
+        """Ключ: нормализованный вопрос + контекст сервера + отпечаток найденного в вики контекста."""
+        fingerprint = hashlib.sha1(context.encode('utf-8')).hexdigest() if context else ""
+        return hashlib.sha1(json.dumps([kind, normalize_query(query), server_context, fingerprint], ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def _remember(self, key, value, created_at):
+        with self.lock:
+            self.memory[key] = (value, created_at); self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_size: self.memory.popitem(last=False)
+
+    def get(self, key):
+        ttl = SETTINGS.get("cache_ttl_hours", 72) * 3600
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry and now - entry[1] < ttl:
+                self.memory.move_to_end(key); self.touched[key] = now
+                return entry[0]
+            self.memory.pop(key, None)
+        with get_engine().begin() as connection:
+            row = connection.execute(sqlalchemy.select(answer_cache_table.c.value, answer_cache_table.c.created_at).where(answer_cache_table.c.key == key)).first()
+            if row is None: return None
+            if now - row.created_at >= ttl:
+                self._delete(connection, [key])
+                return None
+            connection.execute(sqlalchemy.update(answer_cache_table).where(answer_cache_table.c.key == key).values(last_access=now))
+        value = json.loads(row.value)
+        self._remember(key, value, row.created_at)
+        return value
+
+    def put(self, key, kind, value, article_ids=()):
+        now = time.time()
+        with get_engine().begin() as connection:
+            self._delete(connection, [key])
+            connection.execute(sqlalchemy.insert(answer_cache_table).values(key=key, kind=kind, value=json.dumps(value, ensure_ascii=False), created_at=now, last_access=now))
+            if article_ids:
+                connection.execute(sqlalchemy.insert(answer_cache_sources_table), [dict(cache_key=key, article_id=article_id) for article_id in article_ids])
+            with self.lock:
+                touched, self.touched = self.touched, {}
+            if touched:
+                connection.execute(sqlalchemy.update(answer_cache_table).where(answer_cache_table.c.key == sqlalchemy.bindparam('touched_key'), answer_cache_table.c.last_access < sqlalchemy.bindparam('accessed_at')).values(last_access=sqlalchemy.bindparam('accessed_at')),
+                                   [dict(touched_key=key, accessed_at=accessed_at) for key, accessed_at in touched.items()])
+            # LRU-вытеснение: оставляем cache_max_entries самых свежих по последнему обращению
+            max_entries = int(SETTINGS.get("cache_max_entries", 2000))
+            evicted = connection.execute(sqlalchemy.select(answer_cache_table.c.key).order_by(answer_cache_table.c.last_access.desc()).limit(-1).offset(max_entries)).scalars().all()
+            if evicted: self._delete(connection, evicted)
+        self._remember(key, value, now)
+
+    def _delete(self, connection, keys):
+        connection.execute(sqlalchemy.delete(answer_cache_table).where(answer_cache_table.c.key.in_(keys)))
+        connection.execute(sqlalchemy.delete(answer_cache_sources_table).where(answer_cache_sources_table.c.cache_key.in_(keys)))
+        with self.lock:
+            for key in keys: self.memory.pop(key, None)
+
+    def invalidate_articles(self, connection, article_ids):
+        """Удаляет ответы, построенные на указанных статьях (в рамках транзакции записи паука)."""
+        if not article_ids: return
+        keys = connection.execute(sqlalchemy.select(answer_cache_sources_table.c.cache_key).where(answer_cache_sources_table.c.article_id.in_(article_ids)).distinct()).scalars().all()
+        if keys: self._delete(connection, keys)
+
+ANSWER_CACHE = AnswerCache()
+
 # ==============================================================================
 # --- МОДУЛЬ ВЗАИМОДЕЙСТВИЯ С GEMINI AI ---
 # ==============================================================================
@@ -267,70 +1264,202 @@ STOP_WORDS = {
     'делать', 'сделать', 'выбрать', 'построить', 'найти'
 }
 
-def find_relevant_context(keywords, server_context="all"):
+# Веса BM25 для колонок индекса пассажей: заголовок статьи, заголовок раздела, текст
+FTS_COLUMN_WEIGHTS = (10.0, 4.0, 1.0)
+# Сколько лучших пассажей рассматривать при наборе контекста под бюджет
+PASSAGE_CANDIDATES = 40
+
+def build_fts_query(keywords):
+    """Превращает ключевые слова в MATCH-запрос FTS5: префиксный поиск по каждому слову через OR."""
+    terms = [kw.replace('"', ' ').strip() for kw in keywords]
+    return " OR ".join(f'"{term}"*' for term in terms if term)
+
+def find_relevant_context(keywords, server_context="all", budget=None):
+    return find_relevant_passages(keywords, server_context, budget)[0]
+
+def find_relevant_passages(keywords, server_context="all", budget=None):
+    """Собирает контекст из лучших пассажей. Возвращает (контекст, id статей, из которых он собран)."""
     # --- ИЗМЕНЕНИЕ: Отфильтровываем стоп-слова ---
     meaningful_keywords = [kw for kw in keywords if kw not in STOP_WORDS]
-    if not meaningful_keywords: return ""
+    if not meaningful_keywords: return "", []
+    budget = budget or SETTINGS.get("context_char_budget", 12000)
 
-    context = ""
-    with engine.connect() as connection:
-        search_conditions = " OR ".join([f"content LIKE :kw{i}" for i in range(len(meaningful_keywords))])
-        params = {f"kw{i}": f"%{keyword}%" for i, keyword in enumerate(meaningful_keywords)}
-        query_str = f"SELECT title, content FROM wiki_articles WHERE ({search_conditions})"
+    with get_engine().connect() as connection:
+        # Кандидаты приходят сжатыми, распаковываются только пассажи, прошедшие в бюджет контекста
+        query_str = "SELECT p.article_id, p.position, p.title, p.heading, p.text_hash, b.size, b.data, b.codec FROM wiki_passages p JOIN wiki_articles a ON a.id = p.article_id JOIN text_blobs b ON b.hash = p.text_hash"
+        if FTS_AVAILABLE:
+            fts_query = build_fts_query(meaningful_keywords)
+            if not fts_query: return "", []
+            params = {"query": fts_query, "candidates": PASSAGE_CANDIDATES}
+            query_str += " JOIN wiki_passages_fts ON wiki_passages_fts.rowid = p.id WHERE wiki_passages_fts MATCH :query"
+        else:
+            search_conditions = " OR ".join([f"blob_text(b.data, b.codec) LIKE :kw{i}" for i in range(len(meaningful_keywords))])
+            params = {f"kw{i}": f"%{keyword}%" for i, keyword in enumerate(meaningful_keywords)}
+            params["candidates"] = PASSAGE_CANDIDATES
+            query_str += f" WHERE ({search_conditions})"
         if server_context != "all":
             base_url = urlparse(server_context).netloc
-            query_str += " AND source LIKE :server_url"
+            query_str += " AND a.source LIKE :server_url"
             params["server_url"] = f"%{base_url}%"
-        query_str += " LIMIT 5"
-        stmt = text(query_str)
-        results = connection.execute(stmt, params).fetchall()
-        for row in results:
-            context += f"## Статья: {row[0]}\n\n{row[1]}\n\n---\n\n"
-    return context[:20000]
-
-def get_refined_search_keywords_from_gemini(query):
+        if FTS_AVAILABLE:
+            query_str += " ORDER BY bm25(wiki_passages_fts, {}, {}, {})".format(*FTS_COLUMN_WEIGHTS)
+        query_str += " LIMIT :candidates"
+        with STAGE_TIMINGS.span('search.fts' if FTS_AVAILABLE else 'search.like'):
+            results = connection.execute(text(query_str), params).fetchall()
+
+    # Набираем лучшие пассажи, пока они помещаются в бюджет, и группируем их по статьям
+    assemble_started = time.perf_counter()
+    articles, used, seen_hashes = {}, 0, set()
+    for article_id, position, title, heading, passage_hash, content_size, data, codec in results:
+        # Один и тот же абзац с разных зеркал в промпт попадает один раз
+        if passage_hash in seen_hashes: continue
+        # Считаем ровно то, что попадет в контекст: "### заголовок\n...\n\n", а для первого пассажа статьи еще и ее обертку
+        size = content_size + (len(heading) + 7 if heading else 2)
+        if article_id not in articles: size += len(f"## Статья: {title}\n\n---\n\n")
+        if used + size > budget: continue
+        used += size; seen_hashes.add(passage_hash)
+        articles.setdefault(article_id, (title, []))[1].append((position, heading, decompress_text(data, codec)))
+    context = ""
+    for title, passages in articles.values():
+        context += f"## Статья: {title}\n\n"
+        for _, heading, content in sorted(passages):
+            context += f"### {heading}\n{content}\n\n" if heading else f"{content}\n\n"
+        context += "---\n\n"
+    STAGE_TIMINGS.record('search.assemble', time.perf_counter() - assemble_started)
+    return context, list(articles)
+
+async def get_refined_search_keywords_from_gemini(query, session):
     api_key = SETTINGS.get("gemini_api_key", "")
+    cache_key = AnswerCache.make_key('keywords', query)
+    cached_keywords = await asyncio.to_thread(ANSWER_CACHE.get, cache_key)
+    if cached_keywords: return cached_keywords
     prompt = f"""Проанализируй запрос пользователя об игре Space Station 14. Преврати его в список ключевых слов. Выведи только ключевые слова через запятую.
 Запрос: "{query}"
 Ответ:"""
     payload = { "contents": [{"parts": [{"text": prompt}]}], "generationConfig": {"temperature": 0.0} }
     headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {api_key}'}
     try:
-        response = requests.post(VERCEL_PROXY_URL, json=payload, headers=headers, timeout=30)
-        response.raise_for_status()
-        data = response.json()
+        with STAGE_TIMINGS.span('ask.refine'):
+            async with session.post(VERCEL_PROXY_URL, json=payload, headers=headers, timeout=aiohttp.ClientTimeout(total=30)) as response:
+                response.raise_for_status()
+                data = await response.json(content_type=None)
         refined_keywords_text = data['candidates'][0]['content']['parts'][0]['text']
-        return [kw.strip() for kw in refined_keywords_text.split(',')]
+        refined_keywords = [kw.strip() for kw in refined_keywords_text.split(',') if kw.strip()]
+        if refined_keywords: await asyncio.to_thread(ANSWER_CACHE.put, cache_key, 'keywords', refined_keywords)
+        return refined_keywords
     except Exception:
         return []
 
-def ask_gemini(query):
-    api_key = SETTINGS.get("gemini_api_key", "")
-    if not api_key:
-        return "[bold red]Ошибка:[/bold red] API ключ не задан. Пожалуйста, введите его в меню 'настройки'."
-    answer = ""
-    with Live(Spinner('dots', text="[cyan]Анализирую запрос...[/cyan]"), auto_refresh=True, transient=True) as live:
-        current_context_url = SETTINGS.get("current_server_context", "all")
-        context_name = urlparse(current_context_url).netloc if current_context_url != "all" else "Общий"
-        live.update(Spinner('dots', text=f"[cyan]Ищу в контексте '{context_name}'...[/cyan]"))
-        initial_keywords = re.findall(r'\b\w+\b', query.lower())
-        context = find_relevant_context(initial_keywords, server_context=current_context_url)
-        if (not context or len(context) < 200) and current_context_url != "all":
-            live.update(Spinner('dots', text=f"[cyan]В '{context_name}' не найдено. Ищу по всем источникам...[/cyan]"))
-            context = find_relevant_context(initial_keywords, server_context="all")
-        if not context or len(context) < 200:
-            live.update(Spinner('dots', text="[cyan]Уточняю запрос с помощью ИИ...[/cyan]"))
-            refined_keywords = get_refined_search_keywords_from_gemini(query)
-            if refined_keywords:
-                live.update(Spinner('dots', text="[cyan]Ищу по уточненным словам...[/cyan]"))
-                context = find_relevant_context(refined_keywords, server_context="all")
-        
-        if not context:
-            live.update(Spinner('dots', text="[cyan]Локально не найдено. Формирую общий запрос для Gemini...[/cyan]"))
-            prompt = f"Ты — эксперт-помощник по игре Space Station 14. Ответь на следующий вопрос, используя свои знания об этой игре. Всегда отвечай в контексте игры. Вопрос: '{query}'"
-        else:
-            live.update(Spinner('dots', text="[cyan]Информация найдена. Формирую точный запрос для Gemini...[/cyan]"))
-            prompt = f"""Ты — эксперт-помощник по игре Space Station 14. Твоя задача - ответить на вопрос пользователя.
+# Контекст короче этого считается "не найденным" и не останавливает поиск
+MIN_CONTEXT_CHARS = 200
+DEFAULT_RETRIEVAL_BUDGETS = {"search": 2.0, "refine": 30.0, "total": 35.0}
+
+async def retrieve_context(query, server_context="all", session=None, status=None):
+    """Ищет контекст для вопроса конкурентно: поиск в контексте сервера, поиск по всем источникам и
+    (спекулятивно) уточнение запроса через ИИ стартуют одновременно. Побеждает первая по приоритету стадия,
+    давшая не меньше MIN_CONTEXT_CHARS символов, остальные отменяются. Возвращает (контекст, id статей)."""
+    budgets = {**DEFAULT_RETRIEVAL_BUDGETS, **SETTINGS.get("retrieval_budgets", {})}
+    speculative = SETTINGS.get("retrieval_speculative_refine", True)
+    initial_keywords = re.findall(r'\b\w+\b', query.lower())
+    status = status or (lambda message: None)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + budgets["total"]
+
+    async def search(keywords, context_url):
+        return await asyncio.wait_for(asyncio.to_thread(find_relevant_passages, keywords, context_url), budgets["search"])
+
+    async def refined_search(session):
+        refined_keywords = await asyncio.wait_for(get_refined_search_keywords_from_gemini(query, session), budgets["refine"])
+        if not refined_keywords: return None
+        status("[cyan]Ищу по уточненным словам...[/cyan]")
+        return await search(refined_keywords, "all")
+
+    def stage_result(task):
+        return None if task.cancelled() or task.exception() else task.result()
+
+    def fallback(stages):
+        # Достаточного контекста нет: как и раньше, уточненный поиск важнее исходного
+        for name in ('refined', 'global', 'scoped'):
+            if name in stages and stages[name].done() and stage_result(stages[name]) is not None: return stage_result(stages[name])
+        return "", []
+
+    async with contextlib.AsyncExitStack() as stack:
+        if session is None: session = await stack.enter_async_context(aiohttp.ClientSession())
+        stages = {}
+        if server_context != "all": stages['scoped'] = asyncio.create_task(search(initial_keywords, server_context))
+        stages['global'] = asyncio.create_task(search(initial_keywords, "all"))
+        if speculative: stages['refined'] = asyncio.create_task(refined_search(session))
+        try:
+            while True:
+                for name in ('scoped', 'global', 'refined'):
+                    if name not in stages: continue
+                    if not stages[name].done(): break
+                    result = stage_result(stages[name])
+                    if result and len(result[0]) >= MIN_CONTEXT_CHARS: return result
+                else:
+                    if 'refined' in stages: return fallback(stages)
+                    # Без спекуляции уточнение запускается, только когда поиск в базе ничего не дал
+                    status("[cyan]Уточняю запрос с помощью ИИ...[/cyan]")
+                    stages['refined'] = asyncio.create_task(refined_search(session))
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0: return fallback(stages)
+                await asyncio.wait([task for task in stages.values() if not task.done()], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in stages.values(): task.cancel()
+            await asyncio.gather(*stages.values(), return_exceptions=True)
+
+class StreamingUnavailable(Exception):
+    """Прокси не отдал потоковый ответ: нужно повторить запрос обычным способом."""
+
+class ProxyHTTPError(Exception):
+    """Прокси ответил ошибкой HTTP; хранит код и тело ответа."""
+    def __init__(self, status, body):
+        super().__init__(f"HTTP {status}: {body}")
+        self.status = status; self.body = body
+
+# Как часто (в секундах) перерисовывать ответ, пока он приходит по частям
+STREAM_RENDER_INTERVAL = 0.15
+
+async def stream_gemini_answer(session, payload, headers, on_text):
+    """Запрашивает ответ в потоковом режиме (Server-Sent Events) и передает в on_text накопленный текст
+    по мере поступления частей. Бросает StreamingUnavailable, если прокси не умеет стримить."""
+    async with session.post(VERCEL_PROXY_STREAM_URL, json=payload, headers=headers, timeout=aiohttp.ClientTimeout(total=90, sock_connect=10)) as response:
+        # Ключ отклонен или исчерпана квота — обычный запрос ответит тем же, повторять его незачем.
+        # Любую другую ошибку (в том числе 5xx потокового варианта) покажет обычный запрос, если она не только у потока
+        if response.status in (401, 403, 429): raise ProxyHTTPError(response.status, await response.text())
+        if response.status >= 400: raise StreamingUnavailable(f"HTTP {response.status}")
+        if 'text/event-stream' not in response.headers.get('Content-Type', ''): raise StreamingUnavailable(response.headers.get('Content-Type', ''))
+        answer = ""
+        async for raw_line in response.content:
+            line = raw_line.decode('utf-8').strip()
+            if not line.startswith('data:'): continue
+            data = line[5:].strip()
+            if data == '[DONE]': break
+            candidates = json.loads(data).get('candidates') or [{}]
+            piece = ''.join(part.get('text', '') for part in candidates[0].get('content', {}).get('parts', []))
+            if piece:
+                answer += piece; on_text(answer)
+        if not answer: raise StreamingUnavailable("пустой поток")
+        return answer
+
+async def request_gemini_answer(session, payload, headers, on_text=None):
+    """Финальный запрос к Gemini через прокси. С on_text и включенной настройкой gemini_streaming ответ
+    приходит по частям; если поток недоступен, запрос тихо повторяется без стриминга."""
+    if on_text and SETTINGS.get("gemini_streaming", True):
+        try:
+            return await stream_gemini_answer(session, payload, headers, on_text)
+        except (StreamingUnavailable, aiohttp.ClientConnectionError, ValueError):
+            pass
+    async with session.post(VERCEL_PROXY_URL, json=payload, headers=headers, timeout=aiohttp.ClientTimeout(total=90)) as response:
+        if response.status >= 400: raise ProxyHTTPError(response.status, await response.text())
+        data = await response.json(content_type=None)
+    return data['candidates'][0]['content']['parts'][0]['text']
+
+def build_answer_prompt(query, context):
+    if not context:
+        return f"Ты — эксперт-помощник по игре Space Station 14. Ответь на следующий вопрос, используя свои знания об этой игре. Всегда отвечай в контексте игры. Вопрос: '{query}'"
+    return f"""Ты — эксперт-помощник по игре Space Station 14. Твоя задача - ответить на вопрос пользователя.
 Используй предоставленные выдержки из игровой вики как ОСНОВНОЙ и ПРИОРИТЕТНЫЙ источник информации.
 Если в этих выдержках нет ответа или он неполный, ДОПОЛНИ его своими собственными знаниями об игре Space Station 14.
 Всегда оставайся в контексте игры.
@@ -341,34 +1470,272 @@ def ask_gemini(query):
 ---
 ВОПРОС ПОЛЬЗОВАТЕЛЯ: {query}"""
 
+async def answer_question(query, server_context="all", session=None, status=None, on_text=None):
+    """Полный цикл ответа без привязки к интерфейсу: поиск контекста, кэш, запрос к Gemini.
+    status получает сообщения о ходе работы, on_text — частичный ответ при стриминге.
+    Ошибки прокси поднимаются как ProxyHTTPError."""
+    status = status or (lambda message: None)
+    async with contextlib.AsyncExitStack() as stack:
+        stack.enter_context(STAGE_TIMINGS.span('ask.total'))
+        if session is None: session = await stack.enter_async_context(aiohttp.ClientSession())
+        with STAGE_TIMINGS.span('ask.retrieve'):
+            context, article_ids = await retrieve_context(query, server_context, session=session, status=status)
+
+        cache_key = AnswerCache.make_key('answer', query, server_context, context)
+        cached_answer = await asyncio.to_thread(ANSWER_CACHE.get, cache_key)
+        if cached_answer: return cached_answer
+
+        if not context:
+            status("[cyan]Локально не найдено. Формирую общий запрос для Gemini...[/cyan]")
+        else:
+            status("[cyan]Информация найдена. Формирую точный запрос для Gemini...[/cyan]")
+        prompt = build_answer_prompt(query, context)
         payload = { "contents": [{"parts": [{"text": prompt}]}], "generationConfig": {"maxOutputTokens": 8192, "temperature": 0.6}, "safetySettings": [{"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_ONLY_HIGH"}, {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_ONLY_HIGH"}, {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_ONLY_HIGH"}, {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_ONLY_HIGH"}] }
-        headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {api_key}'}
+        headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {SETTINGS.get("gemini_api_key", "")}'}
+        status("[cyan]Отправляю финальный запрос на прокси-сервер...[/cyan]")
+        request_started = time.perf_counter(); first_chunk_seen = False
+        def on_partial_answer(partial_answer):
+            # Время до первого куска потокового ответа: столько пользователь ждет, прежде чем начать читать
+            nonlocal first_chunk_seen
+            if not first_chunk_seen:
+                first_chunk_seen = True; STAGE_TIMINGS.record('ask.first_chunk', time.perf_counter() - request_started)
+            on_text(partial_answer)
+        with STAGE_TIMINGS.span('ask.proxy'):
+            answer = await request_gemini_answer(session, payload, headers, on_text=on_partial_answer if on_text else None)
+        await asyncio.to_thread(ANSWER_CACHE.put, cache_key, 'answer', answer, article_ids)
+        return answer
+
+def ask_gemini(query):
+    from rich.live import Live
+    from rich.markdown import Markdown
+    from rich.spinner import Spinner
+    api_key = SETTINGS.get("gemini_api_key", "")
+    if not api_key:
+        return "[bold red]Ошибка:[/bold red] API ключ не задан. Пожалуйста, введите его в меню 'настройки'."
+    answer = ""
+    with Live(Spinner('dots', text="[cyan]Анализирую запрос...[/cyan]"), auto_refresh=True, transient=True) as live:
+        current_context_url = SETTINGS.get("current_server_context", "all")
+        context_name = urlparse(current_context_url).netloc if current_context_url != "all" else "Общий"
+        search_scope = f"в контексте '{context_name}' и по всем источникам" if current_context_url != "all" else "по всем источникам"
+        live.update(Spinner('dots', text=f"[cyan]Ищу {search_scope}...[/cyan]"))
+        last_render = 0.0
+        def render_partial(partial_answer):
+            # Показываем хвост ответа, помещающийся в окно: Live не умеет прокручивать
+            nonlocal last_render
+            if time.monotonic() - last_render < STREAM_RENDER_INTERVAL: return
+            last_render = time.monotonic()
+            with STAGE_TIMINGS.span('ask.render_stream'):
+                tail = '\n'.join(partial_answer.splitlines()[-max(5, console.height - 6):])
+                live.update(Panel(Markdown(tail), title="[green]Ответ Gemini[/green] [dim](печатает...)[/dim]", border_style="green", padding=(0, 2)))
         try:
-            live.update(Spinner('dots', text="[cyan]Отправляю финальный запрос на прокси-сервер...[/cyan]"))
-            response = requests.post(VERCEL_PROXY_URL, json=payload, headers=headers, timeout=90)
-            response.raise_for_status()
-            data = response.json()
-            answer = data['candidates'][0]['content']['parts'][0]['text']
-        except requests.exceptions.HTTPError as e:
-            answer = f"[bold red]Ошибка HTTP:[/bold red] {e.response.status_code}. Ответ сервера: {e.response.text}"
+            answer = asyncio.run(answer_question(query, current_context_url, status=lambda message: live.update(Spinner('dots', text=message)), on_text=render_partial))
+        except ProxyHTTPError as e:
+            answer = f"[bold red]Ошибка HTTP:[/bold red] {e.status}. Ответ сервера: {e.body}"
         except Exception as e:
             answer = f"[bold red]Произошла непредвиденная ошибка:[/bold red] {e}"
     return answer
 
+# ==============================================================================
+# --- НЕИНТЕРАКТИВНЫЙ РЕЖИМ: ПАКЕТНАЯ ОБРАБОТКА И HTTP-СЕРВИС ---
+# ==============================================================================
+
+class ServiceOverloaded(Exception):
+    """Очередь вопросов переполнена: клиенту стоит повторить запрос позже."""
+
+class QuestionService:
+    """Отвечает на много вопросов одновременно: не больше service_concurrency в работе, не больше
+    service_max_pending принятых (остальные получают ServiceOverloaded), одинаковые вопросы, которые
+    уже обрабатываются, объединяются в один запрос. Все вопросы делят одну HTTP-сессию к прокси."""
+    def __init__(self, session, concurrency, max_pending):
+        self.session = session; self.semaphore = asyncio.Semaphore(concurrency)
+        self.max_pending = max_pending; self.in_flight = {}
+
+    async def answer(self, query, server_context="all"):
+        key = (normalize_query(query), server_context)
+        task = self.in_flight.get(key)
+        if task is None:
+            if len(self.in_flight) >= self.max_pending: raise ServiceOverloaded()
+            # Отдельная задача: отключение первого клиента не должно отменять ответ для остальных
+            task = self.in_flight[key] = asyncio.create_task(self._answer(query, server_context))
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _answer(self, query, server_context):
+        async with self.semaphore:
+            answer = await answer_question(query, server_context, session=self.session)
+        await asyncio.to_thread(STAGE_TIMINGS.export)
+        return answer
+
+def parse_batch_line(line_number, line):
+    """Строка JSONL: {"id": ..., "question": "...", "server_context": "..."} или просто текст вопроса.
+    Возвращает (вопрос, ошибка): строка без непустого вопроса в модель не отправляется. Пустая строка — (None, None)."""
+    line = line.strip()
+    if not line: return None, None
+    try:
+        item = json.loads(line)
+    except ValueError:
+        item = line
+    error = None
+    if isinstance(item, str): item = {"question": item}
+    elif not isinstance(item, dict): item, error = {}, "Ожидается объект JSON или текст вопроса"
+    item.setdefault("id", line_number)
+    if not error and not (isinstance(item.get("question"), str) and item["question"].strip()):
+        error = 'Нет вопроса: ожидается {"question": "..."}'
+    elif not error and not isinstance(item.get("server_context", "all"), str):
+        error = 'server_context должен быть строкой: URL стартовой страницы или "all"'
+    return item, error
+
+async def read_batch_questions(input_file):
+    """Пары (вопрос, ошибка) из файла или stdin. Строки читаются в отдельном потоке: ожидание следующей строки
+    stdin не должно задерживать ответы на уже прочитанные вопросы."""
+    loop = asyncio.get_running_loop()
+    # Очередь на одну строку: поток читает следующую, только когда предыдущую забрали
+    lines = asyncio.Queue(maxsize=1)
+
+    def pump():
+        try:
+            for line in iter(input_file.readline, ''): asyncio.run_coroutine_threadsafe(lines.put(line), loop).result()
+            asyncio.run_coroutine_threadsafe(lines.put(None), loop).result()
+        except Exception:
+            pass  # Цикл событий уже остановлен (Ctrl-C)
+
+    # Поток-демон: заблокированное чтение stdin не мешает завершить процесс
+    threading.Thread(target=pump, daemon=True).start()
+    line_number = 0
+    while (line := await lines.get()) is not None:
+        line_number += 1
+        item, error = parse_batch_line(line_number, line)
+        if item is not None: yield item, error
+
+async def run_batch(service, input_file, output_file, default_context):
+    """Отвечает на вопросы из JSONL и пишет ответы в JSONL в порядке готовности.
+    Новые строки читаются, только когда в очереди есть место."""
+    slots = asyncio.Semaphore(service.max_pending)
+    tasks = set()
+
+    async def handle(item):
+        result = {"id": item["id"], "question": item.get("question", "")}
+        try:
+            result["answer"] = await service.answer(result["question"], item.get("server_context", default_context))
+        except ProxyHTTPError as e:
+            result["error"] = f"HTTP {e.status}: {e.body}"
+        except Exception as e:
+            result["error"] = str(e) or type(e).__name__
+        finally:
+            slots.release()
+        output_file.write(json.dumps(result, ensure_ascii=False) + "\n"); output_file.flush()
+
+    async for item, error in read_batch_questions(input_file):
+        if error:
+            output_file.write(json.dumps({"id": item["id"], "question": item.get("question", ""), "error": error}, ensure_ascii=False) + "\n"); output_file.flush()
+            continue
+        await slots.acquire()
+        task = asyncio.create_task(handle(item)); tasks.add(task); task.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks)
+
+async def serve_http(service, host, port, default_context):
+    """Локальный HTTP-сервис: POST /ask {"question": "...", "server_context": "..."} -> {"answer": "..."}."""
+    from aiohttp import web
+    async def ask(request):
+        try:
+            body = await request.json()
+            question = body["question"].strip()
+            server_context = body.get("server_context", default_context)
+            if not question or not isinstance(server_context, str): raise ValueError
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return web.json_response({"error": 'Ожидается JSON вида {"question": "...", "server_context": "all"}'}, status=400)
+        try:
+            answer = await service.answer(question, server_context)
+        except ServiceOverloaded:
+            return web.json_response({"error": "Слишком много вопросов, повторите позже"}, status=503, headers={"Retry-After": "1"})
+        except ProxyHTTPError as e:
+            return web.json_response({"error": f"Прокси ответил HTTP {e.status}", "details": e.body}, status=502)
+        except Exception as e:
+            return web.json_response({"error": str(e) or type(e).__name__}, status=500)
+        return web.json_response({"question": question, "answer": answer})
+
+    async def health(request):
+        return web.json_response({"status": "ok", "in_flight": len(service.in_flight)})
+
+    app = web.Application(client_max_size=64 * 1024)
+    app.router.add_post('/ask', ask); app.router.add_get('/health', health)
+    runner = web.AppRunner(app); await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+        console.print(f"SS14 Helper слушает http://{host}:{port}/ask")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+async def run_headless(args):
+    # to_thread ходит в БД через пул соединений движка: потоков не больше, чем соединений в нем
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=DB_POOL_SIZE + DB_POOL_OVERFLOW))
+    concurrency = args.concurrency or int(SETTINGS.get("service_concurrency", 8))
+    max_pending = max(concurrency, int(SETTINGS.get("service_max_pending", 64)))
+    default_context = args.context or SETTINGS.get("current_server_context", "all")
+    connector = aiohttp.TCPConnector(limit=concurrency * 2, keepalive_timeout=60)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        service = QuestionService(session, concurrency, max_pending)
+        if args.serve:
+            await serve_http(service, args.host, args.port, default_context)
+        else:
+            input_file = sys.stdin if args.batch == '-' else open(args.batch, encoding='utf-8')
+            output_file = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+            try:
+                await run_batch(service, input_file, output_file, default_context)
+            finally:
+                if input_file is not sys.stdin: input_file.close()
+                if output_file is not sys.stdout: output_file.close()
+
+def warm_up():
+    """Фоновая подготовка интерактивного режима: открывает БД (со всеми миграциями) и загружает модули,
+    нужные для ответа, чтобы первый вопрос не платил за них."""
+    try:
+        get_engine()
+        import rich.markdown, rich.live, rich.spinner
+    except Exception:
+        pass  # Ошибка повторится и будет показана при первом вопросе
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="SS14 Helper. Без аргументов запускается интерактивный режим.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--batch', metavar='FILE', help="ответить на вопросы из JSONL-файла ('-' — stdin)")
+    mode.add_argument('--serve', action='store_true', help="запустить локальный HTTP-сервис (POST /ask)")
+    parser.add_argument('--output', metavar='FILE', help="куда писать ответы в пакетном режиме (по умолчанию stdout)")
+    parser.add_argument('--host', default='127.0.0.1'); parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--concurrency', type=int, help="сколько вопросов обрабатывать одновременно")
+    parser.add_argument('--context', help="контекст сервера по умолчанию (URL стартовой страницы или all)")
+    return parser.parse_args()
+
 # ==============================================================================
 # --- ОСНОВНОЙ ЦИКЛ ПРОГРАММЫ ---
 # ==============================================================================
 
 if __name__ == '__main__':
+    args = parse_args()
+    if args.batch or args.serve:
+        # stdout отдан под ответы: сообщения общего кода (создание настроек, миграции, экспорт замеров) идут в stderr
+        console = Console(stderr=True)
+        if not SETTINGS.get("gemini_api_key", ""):
+            sys.exit("Ошибка: API ключ не задан. Задайте gemini_api_key в settings.json.")
+        try:
+            asyncio.run(run_headless(args))
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
     welcome_message = """
 [bold]Привет! Я твой помощник по Space Station 14.[/bold]
 
-- Введи '[bold]обновить[/bold]' для загрузки свежих данных.
+- Введи '[bold]обновить[/bold]' для загрузки свежих данных ('[bold]обновить полностью[/bold]' — полный обход сайтов).
 - Введи '[bold]настройки[/bold]' для изменения параметров.
 - Введи '[bold]сервер[/bold]' для смены контекста поиска.
+- Введи '[bold]статистика[/bold]' для просмотра времени этапов, '[bold]профиль <вопрос>[/bold]' — ответ с профилированием.
 - Введи '[bold]выход[/bold]' для завершения.
     """
     console.print(Panel(welcome_message, title="[yellow]SS14 Helper[/yellow]", border_style="blue"))
+    # Пока пользователь набирает вопрос, в фоне готовим БД и модули отрисовки ответа
+    threading.Thread(target=warm_up, daemon=True).start()
 
     while True:
         context_url = SETTINGS.get("current_server_context", "all")
@@ -381,10 +1748,20 @@ if __name__ == '__main__':
             break
         elif user_input.lower() == 'обновить':
             autonomous_update()
+        elif user_input.lower() == 'обновить полностью':
+            autonomous_update(full=True)
         elif user_input.lower() == 'настройки':
             manage_settings()
         elif user_input.lower() in ['сервер', 'контекст']:
             manage_server_context()
+        elif user_input.lower() == 'статистика':
+            show_statistics()
         else:
-            answer = ask_gemini(user_input)
-            console.print(Panel(Markdown(answer), title="[green]Ответ Gemini[/green]", border_style="green", padding=(1, 2)))
+            if user_input.lower().startswith('профиль ') and user_input[8:].strip():
+                answer = profile_question(user_input[8:].strip())
+            else:
+                answer = ask_gemini(user_input)
+            with STAGE_TIMINGS.span('ask.render'):
+                from rich.markdown import Markdown
+                console.print(Panel(Markdown(answer), title="[green]Ответ Gemini[/green]", border_style="green", padding=(1, 2)))
+            STAGE_TIMINGS.export()